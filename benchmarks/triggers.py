@@ -0,0 +1,57 @@
+"""比較 TriggerEngine 與逐條比對 (原本的 if/elif 串) 的單則訊息耗時
+
+於專案根目錄執行：python -m benchmarks.triggers
+"""
+import re
+import timeit
+from typing import Any, Dict, Optional
+
+from bot.configs import Events
+from bot.core import TriggerEngine
+
+SAMPLES = {
+    "no match, short": {"content": "今天午餐吃什麼", "author": "someone"},
+    "no match, 300 CJK": {"content": "今天天氣不錯" * 50, "author": "someone"},
+    "no match, 300 mixed": {"content": "hello 世界 123 " * 25, "author": "someone"},
+    "late match (怕)": {"content": "今天天氣不錯" * 10 + "怕", "author": "someone"},
+}
+
+
+class ChainMatcher:
+    """依優先序逐條比對所有規則，與原本 on_message 的 if/elif 串相同"""
+
+    def __init__(self, rules) -> None:
+        self.rules = [
+            (
+                rule,
+                rule.get("field", "content"),
+                re.compile(rule["pattern"]),
+                re.compile(rule["unless"]) if rule.get("unless") else None,
+            )
+            for rule in rules
+        ]
+
+    def match(self, **fields: str) -> Optional[Dict[str, Any]]:
+        for rule, field, pattern, unless in self.rules:
+            text = fields.get(field)
+            if text is None or pattern.search(text) is None:
+                continue
+            if unless is not None and unless.search(text):
+                continue
+            return rule
+        return None
+
+
+def main(number: int = 20000) -> None:
+    engine = TriggerEngine(Events.triggers)
+    chain = ChainMatcher(Events.triggers)
+
+    for name, fields in SAMPLES.items():
+        assert engine.match(**fields) == chain.match(**fields), name
+        old = timeit.timeit(lambda: chain.match(**fields), number=number)
+        new = timeit.timeit(lambda: engine.match(**fields), number=number)
+        print(f"{name:<22} {old / number * 1e6:6.1f}us -> {new / number * 1e6:6.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import logging
 
+import discord
 from discord.ext import commands
 
 from bot.configs import Bot
@@ -13,10 +14,41 @@ __all__ = [
 
 class ItkBot(commands.Bot):
     def __init__(self, *args, **options) -> None:
+        from bot.configs import Events, Tasks
+        from bot.core import (
+            AssetManager,
+            BackupStore,
+            MessageArchive,
+            MongoPool,
+            Paginator,
+            PhashIndex,
+            ReactionDispatcher,
+        )
+
         super().__init__(*args, **options)
         self.ext_path_mapping = {}
         self.ignore_kw_list = []
 
+        self.mongo = MongoPool()
+        self.reactions = ReactionDispatcher(
+            Bot.reaction_dispatcher.maxsize, Bot.reaction_dispatcher.ttl
+        )
+        self.paginator = Paginator(self, Bot.paginator.maxsize, Bot.paginator.ttl)
+
+        self.assets = AssetManager(self, Bot.asset_cache_bytes)
+        self.assets.preload(Events, Tasks)
+
+        self.phashes = PhashIndex(Bot.phash_index.path)
+        self.backups = BackupStore(
+            Bot.backup.folder,
+            Bot.backup.index,
+            workers=Bot.backup.download_workers,
+            queue_size=Bot.backup.download_queue_size,
+            max_file_bytes=Bot.backup.max_file_bytes,
+            phash_index=self.phashes,
+        )
+        self.archive = MessageArchive(Bot.archive.path)
+
     def load_all_extensions(self) -> None:
         from bot.core import EXTENSIONS
 
@@ -41,6 +73,24 @@ class ItkBot(commands.Bot):
 
         logger.info(f"Reloaded | {name.rsplit('.', 1)[-1].capitalize()}")
 
+    async def close(self) -> None:
+        from bot.core import CogInit
+
+        # 在卸載 cog 及關閉資料庫前，先讓各 cog 寫回暫存資料
+        for cog in tuple(self.cogs.values()):
+            if isinstance(cog, CogInit):
+                try:
+                    await cog.cog_close()
+                except Exception:
+                    logger.exception(f"Failed to close {cog.qualified_name}")
+
+        await super().close()
+
+        self.mongo.close()
+        await self.backups.close()
+        self.archive.close()
+        self.phashes.close()
+
     async def on_ready(self) -> None:
         from random import choice
 
@@ -56,10 +106,25 @@ class ItkBot(commands.Bot):
         for word in Bot.ignore_keywords:
             self.ignore_kw_list.append(word)
 
+        # 將啟用相似圖片索引前的備份加入索引
+        self.backups.start_phash_backfill()
+
         logger.info("Bot is ready.")
         await self.get_channel(Bot.log_channel).send(
             f"親愛的海倫向你早安 {choice(Emojis.helens)}"
         )
 
+    async def on_raw_reaction_add(
+        self, payload: discord.RawReactionActionEvent
+    ) -> None:
+        # 依訊息 ID 交給登記的處理函式，其餘反應不會喚醒任何 Cog
+        await self.reactions.dispatch(payload)
+
+    async def on_raw_message_delete(
+        self, payload: discord.RawMessageDeleteEvent
+    ) -> None:
+        self.paginator.discard(payload.message_id)
+        self.reactions.unregister_message(payload.message_id)
+
     async def on_command(self, ctx: commands.Context) -> None:
         logger.trace(f"{ctx.author} ({ctx.author.id}) | `{ctx.message.content}`")
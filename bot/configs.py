@@ -17,6 +17,7 @@ __all__ = [
     "HelpMessages",
     "Events",
     "Fun",
+    "Cmds",
     "Tasks",
 ]
 
@@ -63,4 +64,6 @@ Events: Dict = _CONFIG_DICT.events
 
 Fun: Dict = _CONFIG_DICT.fun
 
+Cmds: Dict = _CONFIG_DICT.cmds
+
 Tasks: Dict = _CONFIG_DICT.tasks
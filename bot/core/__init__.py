@@ -1,3 +1,16 @@
+from bot.core.archive import *
+from bot.core.assets import *
+from bot.core.backup import *
+from bot.core.cache import *
 from bot.core.cog import *
+from bot.core.image_hash import *
+from bot.core.key_pool import *
+from bot.core.message_store import *
 from bot.core.mongo import *
+from bot.core.paginator import *
+from bot.core.phash_index import *
+from bot.core.rate_limit import *
+from bot.core.reactions import *
+from bot.core.sqlite_cache import *
+from bot.core.triggers import *
 from bot.core.extensions import *
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+__all__ = [
+    "MessageArchive",
+]
+
+logger = logging.getLogger(__name__)
+
+# 中日韓文字沒有以空白分詞，改以單字及雙字 n-gram 建立索引
+_CJK_RUN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id           INTEGER PRIMARY KEY,
+    message_id   INTEGER NOT NULL,
+    kind         TEXT    NOT NULL,
+    author_id    INTEGER NOT NULL,
+    author_name  TEXT    NOT NULL,
+    channel_id   INTEGER NOT NULL,
+    channel_name TEXT    NOT NULL,
+    created_at   REAL    NOT NULL,
+    logged_at    REAL    NOT NULL,
+    content      TEXT    NOT NULL,
+    before       TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (tokens, content = '');
+"""
+
+
+def _tokenize(text: str, query: bool = False) -> List[str]:
+    """將文字切為索引用的詞，中日韓文字以 n-gram 表示
+
+    建立索引時同時產生單字及雙字；查詢時只使用雙字 (單一字元時使用單字)，
+    以減少比對的詞數。
+    """
+    tokens = []
+    pos = 0
+    for match in _CJK_RUN.finditer(text):
+        tokens.extend(re.findall(r"\w+", text[pos : match.start()].lower()))
+        run = match[0]
+        if not query or len(run) == 1:
+            tokens.extend(run)
+        tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+        pos = match.end()
+    tokens.extend(re.findall(r"\w+", text[pos:].lower()))
+    return tokens
+
+
+class MessageArchive:
+    """保存被刪除及編輯的訊息，並以 SQLite FTS5 建立全文索引
+
+    FTS5 預設的分詞器無法切分中文，寫入時先將文字轉為以空白分隔的 n-gram，
+    搜尋時以相同方式切分關鍵字，最後再以原文比對排除 n-gram 的誤判。
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _add(self, record: Dict[str, Any]) -> None:
+        tokens = _tokenize(record["content"]) + _tokenize(record.get("before") or "")
+        with self._db:
+            cursor = self._db.execute(
+                "INSERT INTO messages (message_id, kind, author_id, author_name,"
+                " channel_id, channel_name, created_at, logged_at, content, before)"
+                " VALUES (:message_id, :kind, :author_id, :author_name, :channel_id,"
+                " :channel_name, :created_at, :logged_at, :content, :before)",
+                {"before": None, "logged_at": time.time(), **record},
+            )
+            self._db.execute(
+                "INSERT INTO messages_fts (rowid, tokens) VALUES (?, ?)",
+                (cursor.lastrowid, " ".join(tokens)),
+            )
+
+    async def add(
+        self,
+        kind: str,
+        message_id: int,
+        author_id: int,
+        author_name: str,
+        channel_id: int,
+        channel_name: str,
+        created_at: datetime,
+        content: str,
+        before: Optional[str] = None,
+    ) -> None:
+        """記錄一則被刪除 (`delete`) 或編輯 (`edit`) 的訊息"""
+        # discord.py 的時間為不含時區的 UTC
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        await self._run(
+            self._add,
+            {
+                "kind": kind,
+                "message_id": message_id,
+                "author_id": author_id,
+                "author_name": author_name,
+                "channel_id": channel_id,
+                "channel_name": channel_name,
+                "created_at": created_at.timestamp(),
+                "content": content,
+                "before": before,
+            },
+        )
+
+    def _search(
+        self,
+        keywords: List[str],
+        author: Optional[str],
+        channel: Optional[str],
+        since: Optional[float],
+        until: Optional[float],
+        limit: int,
+        offset: int,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        conditions, params = [], []
+        tokens = list(
+            dict.fromkeys(
+                token for keyword in keywords for token in _tokenize(keyword, True)
+            )
+        )
+        if tokens:
+            conditions.append(
+                "id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)"
+            )
+            params.append(" AND ".join(f'"{token}"' for token in tokens))
+        for keyword in keywords:
+            # n-gram 只保證各片段皆出現，以原文確認每個關鍵字確實相連
+            conditions.append(
+                "(instr(lower(content), ?) OR instr(lower(ifnull(before, '')), ?))"
+            )
+            params.extend((keyword.lower(), keyword.lower()))
+        for column, value in (("author", author), ("channel", channel)):
+            if value is None:
+                continue
+            if value.isdigit():
+                conditions.append(f"{column}_id = ?")
+                params.append(int(value))
+            else:
+                conditions.append(f"instr(lower({column}_name), ?)")
+                params.append(value.lower())
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(until)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        total = self._db.execute(
+            f"SELECT count(*) FROM messages {where}", params
+        ).fetchone()[0]
+
+        cursor = self._db.cursor()
+        cursor.row_factory = sqlite3.Row
+        rows = cursor.execute(
+            f"SELECT * FROM messages {where}"
+            " ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            (*params, limit, offset),
+        ).fetchall()
+        return total, [dict(row) for row in rows]
+
+    async def search(
+        self,
+        keyword: str = "",
+        author: Optional[str] = None,
+        channel: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: int = 10,
+        offset: int = 0,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """搜尋記錄，以空白分隔的關鍵字須全部出現 (不需相連)，
+        author / channel 可為 ID 或名稱的一部分
+
+        回傳 (符合的總數, 依建立時間由新到舊排列的記錄)
+        """
+        return await self._run(
+            self._search,
+            keyword.split(),
+            author,
+            channel,
+            since.timestamp() if since else None,
+            until.timestamp() if until else None,
+            limit,
+            offset,
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._db.close()
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import io
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Union
+
+import discord
+
+from bot.configs import Bot
+
+__all__ = [
+    "AssetManager",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_paths(config: Any) -> Iterator[str]:
+    """遞迴找出設定中所有位於圖片資料夾內的路徑"""
+    if isinstance(config, dict):
+        for value in config.values():
+            yield from _iter_paths(value)
+    elif isinstance(config, (list, tuple)):
+        for value in config:
+            yield from _iter_paths(value)
+    elif isinstance(config, str) and config.startswith(Bot.image_folder):
+        yield config
+
+
+class AssetManager:
+    """將回覆用的圖片保留在記憶體內，超過容量上限時移除最久未使用的圖片
+
+    啟用上傳快取時，每張圖片只會上傳一次至 `Bot.asset_upload.channel`，
+    之後以 Embed 引用該附件的網址，不再重複上傳檔案。
+    """
+
+    def __init__(self, bot: discord.Client, max_bytes: int) -> None:
+        self.bot = bot
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._assets: "OrderedDict[str, bytes]" = OrderedDict()
+        # 路徑 -> 檔案內容的 SHA-256，用於判斷已上傳的附件是否過時
+        self._hashes: Dict[str, str] = {}
+
+        # 路徑 -> {"sha256", "channel_id", "message_id", "url", "refreshed_at"}
+        self._uploads: Optional[Dict[str, Dict[str, Any]]] = None
+        self._uploads_lock = asyncio.Lock()
+        # 同一張圖片同時只上傳一次，不同圖片互不等待
+        self._upload_locks: Dict[str, asyncio.Lock] = {}
+
+    def preload(self, *configs: Any) -> None:
+        """讀取設定內引用的所有圖片，並確認檔案皆存在"""
+        paths = list(
+            dict.fromkeys(p for config in configs for p in _iter_paths(config))
+        )
+        missing = [p for p in paths if not Path(p).is_file()]
+        for path in missing:
+            logger.error(f"Asset not found | {path}")
+
+        for path in paths:
+            if path not in missing:
+                self._load(path)
+        logger.info(
+            f"Preloaded {len(self._assets)} / {len(paths)} assets"
+            f" | {self.used_bytes / 1048576:.1f} MiB"
+        )
+
+    def _load(self, path: str) -> bytes:
+        data = Path(path).read_bytes()
+        self._hashes[path] = hashlib.sha256(data).hexdigest()
+        # 單一檔案超過上限則不快取
+        if len(data) > self.max_bytes:
+            return data
+
+        self._assets[path] = data
+        self.used_bytes += len(data)
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self._assets.popitem(last=False)
+            self.used_bytes -= len(evicted)
+        return data
+
+    def read(self, path: str) -> bytes:
+        data = self._assets.get(path)
+        if data is None:
+            return self._load(path)
+
+        self._assets.move_to_end(path)
+        return data
+
+    def file(self, path: str, **kwargs) -> discord.File:
+        """回傳以記憶體內容建立的新 discord.File，每次傳送都需要新的物件"""
+        return discord.File(
+            io.BytesIO(self.read(path)), filename=Path(path).name, **kwargs
+        )
+
+    @property
+    def _mongo(self):
+        return self.bot.mongo.get("discord_669934356172636199", "asset_uploads")
+
+    async def _get_uploads(self) -> Dict[str, Dict[str, Any]]:
+        async with self._uploads_lock:
+            if self._uploads is None:
+                self._uploads = {
+                    doc.pop("_id"): doc for doc in await self._mongo.find()
+                }
+        return self._uploads
+
+    def _cached_url(self, path: str) -> Optional[str]:
+        """上傳記錄仍有效且網址未過期時回傳網址，不需任何網路請求"""
+        record = self._uploads.get(path) if self._uploads is not None else None
+        # 檔案內容已變更，需重新上傳
+        if record is None or record["sha256"] != self._hashes[path]:
+            return None
+        if time.time() - record["refreshed_at"] >= Bot.asset_upload.url_ttl:
+            return None
+        return record["url"]
+
+    async def _upload(self, path: str) -> Optional[Dict[str, Any]]:
+        channel = self.bot.get_channel(int(Bot.asset_upload.channel))
+        if channel is None:
+            return None
+
+        upload_msg = await channel.send(file=self.file(path))
+        record = {
+            "sha256": self._hashes[path],
+            "channel_id": channel.id,
+            "message_id": upload_msg.id,
+            "url": upload_msg.attachments[0].url,
+            "refreshed_at": time.time(),
+        }
+        await self._mongo.update({"_id": path}, {"$set": record})
+        logger.info(f"Uploaded asset | {path}")
+        return record
+
+    async def _refresh(self, path: str, record: Dict[str, Any]) -> Optional[str]:
+        # 附件網址帶有時效簽章，重新取得訊息即可拿到新的網址
+        channel = self.bot.get_channel(record["channel_id"])
+        if channel is None:
+            return None
+        try:
+            upload_msg = await channel.fetch_message(record["message_id"])
+        except discord.NotFound:
+            return None
+
+        record["url"] = upload_msg.attachments[0].url
+        record["refreshed_at"] = time.time()
+        await self._mongo.update(
+            {"_id": path},
+            {"$set": {"url": record["url"], "refreshed_at": record["refreshed_at"]}},
+        )
+        return record["url"]
+
+    async def url(self, path: str) -> Optional[str]:
+        """回傳圖片已上傳附件的網址，必要時先上傳"""
+        # 未設定上傳頻道時直接傳送檔案
+        if not Bot.asset_upload.enabled or not Bot.asset_upload.channel:
+            return None
+        if path not in self._hashes:
+            self.read(path)
+
+        url = self._cached_url(path)
+        if url is not None:
+            return url
+
+        async with self._upload_locks.setdefault(path, asyncio.Lock()):
+            uploads = await self._get_uploads()
+            # 等待期間可能已由其他呼叫上傳或更新
+            url = self._cached_url(path)
+            if url is not None:
+                return url
+
+            record = uploads.get(path)
+            if record is not None and record["sha256"] == self._hashes[path]:
+                url = await self._refresh(path, record)
+                if url is not None:
+                    return url
+
+            record = await self._upload(path)
+            if record is None:
+                return None
+            uploads[path] = record
+            return record["url"]
+
+    async def send(
+        self,
+        target: Union[discord.abc.Messageable, discord.Message],
+        path: str,
+        content: Optional[str] = None,
+        **kwargs,
+    ) -> discord.Message:
+        """傳送圖片，傳入訊息時以回覆的方式傳送"""
+        send = target.reply if isinstance(target, discord.Message) else target.send
+
+        try:
+            url = await self.url(path)
+        except Exception:
+            # 上傳快取失敗 (Discord 或 Mongo) 時改為直接傳送檔案
+            logger.exception(f"Failed to get the uploaded url of {path}")
+            url = None
+
+        if url is not None:
+            embed = discord.Embed().set_image(url=url)
+            return await send(content, embed=embed, **kwargs)
+        return await send(content, file=self.file(path), **kwargs)
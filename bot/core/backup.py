@@ -0,0 +1,503 @@
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import aiohttp
+
+if TYPE_CHECKING:
+    from bot.core.phash_index import PhashIndex
+
+__all__ = [
+    "BackupStore",
+    "BackupFile",
+]
+
+logger = logging.getLogger(__name__)
+
+# Discord 的 snowflake 起算時間 (ms)
+_DISCORD_EPOCH = 1420070400000
+
+# 舊版以 <訊息 ID>_<序號>.<副檔名> 命名的備份檔
+_LEGACY_NAME = re.compile(r"^(\d+)_(\d+)\.(\w+)$")
+# 內容定址的備份檔 <sha256>.<副檔名>
+_BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.\w+$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash       TEXT PRIMARY KEY,
+    ext        TEXT    NOT NULL,
+    size       INTEGER NOT NULL,
+    refs       INTEGER NOT NULL,
+    created_at REAL    NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    message_id INTEGER NOT NULL,
+    idx        INTEGER NOT NULL,
+    hash       TEXT    NOT NULL REFERENCES blobs (hash),
+    PRIMARY KEY (message_id, idx)
+);
+"""
+
+
+class BackupFile(NamedTuple):
+    idx: int
+    hash: str
+    ext: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.hash}.{self.ext}"
+
+
+class BackupStore:
+    """以內容雜湊去除重複的附件備份，並以訊息 ID 建立索引
+
+    檔案存放為 `<folder>/<sha256>.<ext>`，相同內容只保存一份並記錄引用數；
+    索引保存在 SQLite 內，啟動時載入記憶體，查詢不需掃描資料夾。
+    資料庫寫入及檔案 I/O 皆在單一執行緒內依序進行，不阻塞事件迴圈。
+    `sweep` 依保存期限及容量上限，由最舊的訊息開始移除備份。
+
+    `enqueue` 將附件下載交給固定數量的背景工作，佇列已滿或檔案過大時直接略過；
+    下載時分段寫入暫存檔並同時計算雜湊，完成後再改名為內容定址的檔名。
+    """
+
+    # 下載時每次寫入的大小
+    CHUNK_SIZE = 65536
+
+    def __init__(
+        self,
+        folder: Union[str, Path],
+        index_path: Union[str, Path],
+        workers: int = 3,
+        queue_size: int = 50,
+        max_file_bytes: int = 8388608,
+        download_timeout: float = 60,
+        phash_index: Optional["PhashIndex"] = None,
+    ) -> None:
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        # 清除上次未完成下載的暫存檔
+        for part in self.folder.glob(".*.part"):
+            part.unlink()
+
+        self.max_file_bytes = max_file_bytes
+        # 下載完成的圖片一併記錄至相似圖片索引
+        self.phash_index = phash_index
+        self.download_timeout = download_timeout
+        self._worker_count = workers
+        self._queue: "asyncio.Queue[Tuple[int, int, str, str, Dict[str, Any]]]" = (
+            asyncio.Queue(maxsize=queue_size)
+        )
+        self._workers: List[asyncio.Task] = []
+        self._backfill: Optional[asyncio.Task] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 訊息 ID -> 尚未完成的下載數量，以及全部完成時觸發的事件
+        self._pending: Counter = Counter()
+        self._idle: Dict[int, asyncio.Event] = {}
+        # 下載完成前就被移除的訊息，完成的下載直接捨棄
+        self._removed: Set[int] = set()
+        self.skipped_downloads = 0
+
+        self._db = sqlite3.connect(str(index_path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup")
+
+        # 訊息 ID -> 已備份的附件
+        self._index: Dict[int, List[BackupFile]] = {}
+        # 雜湊 -> 引用數
+        self._refs: Dict[str, int] = {}
+        # 雜湊 -> 檔案大小
+        self._sizes: Dict[str, int] = {}
+        self.used_bytes = 0
+        # 啟動以來因保存期限或容量上限而移除的檔案
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+        for message_id, idx, blob_hash, ext in self._db.execute(
+            "SELECT a.message_id, a.idx, a.hash, b.ext"
+            " FROM attachments a JOIN blobs b ON a.hash = b.hash"
+            " ORDER BY a.message_id, a.idx"
+        ):
+            self._index.setdefault(message_id, []).append(
+                BackupFile(idx, blob_hash, ext)
+            )
+        for blob_hash, refs, size in self._db.execute(
+            "SELECT hash, refs, size FROM blobs"
+        ):
+            self._refs[blob_hash] = refs
+            self._sizes[blob_hash] = size
+        self.used_bytes = sum(self._sizes.values())
+
+        self._migrate_legacy()
+        self._remove_unreferenced()
+        logger.info(
+            f"Backup index loaded | {len(self._index)} messages, {len(self._refs)} files"
+        )
+
+    def path(self, file: BackupFile) -> Path:
+        return self.folder / file.name
+
+    def files(self, message_id: int) -> List[BackupFile]:
+        return self._index.get(message_id, [])
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _insert(
+        self, message_id: int, idx: int, blob_hash: str, ext: str, size: int
+    ) -> BackupFile:
+        with self._db:
+            self._db.execute(
+                "INSERT INTO blobs VALUES (?, ?, ?, 1, ?)"
+                " ON CONFLICT (hash) DO UPDATE SET refs = refs + 1",
+                (blob_hash, ext, size, time.time()),
+            )
+            self._db.execute(
+                "INSERT INTO attachments VALUES (?, ?, ?)",
+                (message_id, idx, blob_hash),
+            )
+        return BackupFile(idx, blob_hash, ext)
+
+    def _stored_ext(self, blob_hash: str, ext: str) -> str:
+        """相同內容已存在時沿用原本的副檔名，每個雜湊只對應一個檔案"""
+        row = self._db.execute(
+            "SELECT ext FROM blobs WHERE hash = ?", (blob_hash,)
+        ).fetchone()
+        return row[0] if row else ext
+
+    def _add(self, message_id: int, idx: int, data: bytes, ext: str) -> BackupFile:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        ext = self._stored_ext(blob_hash, ext)
+        path = self.folder / f"{blob_hash}.{ext}"
+        if not path.exists():
+            path.write_bytes(data)
+        return self._insert(message_id, idx, blob_hash, ext, len(data))
+
+    def _add_part(
+        self, message_id: int, idx: int, part: Path, blob_hash: str, ext: str, size: int
+    ) -> BackupFile:
+        ext = self._stored_ext(blob_hash, ext)
+        path = self.folder / f"{blob_hash}.{ext}"
+        # 相同內容已存在時捨棄暫存檔
+        if path.exists():
+            part.unlink()
+        else:
+            part.replace(path)
+        return self._insert(message_id, idx, blob_hash, ext, size)
+
+    def _track(self, message_id: int, file: BackupFile, size: int) -> None:
+        if file.hash not in self._refs:
+            self._sizes[file.hash] = size
+            self.used_bytes += size
+        self._refs[file.hash] = self._refs.get(file.hash, 0) + 1
+        self._index.setdefault(message_id, []).append(file)
+
+    def _release(self, files: List[Tuple[int, List[BackupFile]]]) -> None:
+        with self._db:
+            for message_id, message_files in files:
+                self._db.execute(
+                    "DELETE FROM attachments WHERE message_id = ?", (message_id,)
+                )
+                for file in message_files:
+                    self._db.execute(
+                        "UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (file.hash,)
+                    )
+            orphans = self._db.execute(
+                "SELECT hash, ext FROM blobs WHERE refs <= 0"
+            ).fetchall()
+            self._db.execute("DELETE FROM blobs WHERE refs <= 0")
+
+        for blob_hash, ext in orphans:
+            (self.folder / f"{blob_hash}.{ext}").unlink(missing_ok=True)
+
+    def enqueue(
+        self,
+        message_id: int,
+        idx: int,
+        url: str,
+        ext: str,
+        size: int,
+        **meta: Optional[int],
+    ) -> bool:
+        """排入附件下載，佇列已滿或檔案過大時略過並回傳 False
+
+        meta (guild_id、channel_id、author_id) 會隨圖片記錄至相似圖片索引
+        """
+        if any(file.idx == idx for file in self.files(message_id)):
+            return False
+        if size > self.max_file_bytes:
+            logger.debug(f"Backup skipped (too large) | {message_id}_{idx}")
+            return False
+
+        self._start_workers()
+        try:
+            self._queue.put_nowait((message_id, idx, url, ext.lower(), meta))
+        except asyncio.QueueFull:
+            self.skipped_downloads += 1
+            logger.warning(f"Backup skipped (queue full) | {message_id}_{idx}")
+            return False
+
+        self._pending[message_id] += 1
+        self._idle.setdefault(message_id, asyncio.Event())
+        return True
+
+    async def wait(self, message_id: int, timeout: float) -> None:
+        """等待訊息尚未完成的附件下載，最多等待 timeout 秒"""
+        event = self._idle.get(message_id)
+        if event is None:
+            return
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _start_workers(self) -> None:
+        if self._workers:
+            return
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.download_timeout)
+        )
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self._worker_count)
+        ]
+
+    async def _worker(self) -> None:
+        while True:
+            message_id, idx, url, ext, meta = await self._queue.get()
+            try:
+                await self._download(message_id, idx, url, ext, meta)
+            except Exception:
+                logger.exception(f"Failed to back up {message_id}_{idx}")
+            finally:
+                self._queue.task_done()
+                self._pending[message_id] -= 1
+                if self._pending[message_id] <= 0:
+                    del self._pending[message_id]
+                    self._removed.discard(message_id)
+                    self._idle.pop(message_id).set()
+
+    @staticmethod
+    def _write_chunk(f: BinaryIO, digest: "hashlib._Hash", chunk: bytes) -> None:
+        digest.update(chunk)
+        f.write(chunk)
+
+    @staticmethod
+    def _discard_part(f: BinaryIO, part: Path) -> None:
+        f.close()
+        part.unlink()
+
+    async def _download(
+        self, message_id: int, idx: int, url: str, ext: str, meta: Dict[str, Any]
+    ) -> None:
+        part = self.folder / f".{message_id}_{idx}.part"
+        digest = hashlib.sha256()
+        size = 0
+        f = None
+        try:
+            async with self._session.get(url) as resp:
+                resp.raise_for_status()
+                # 開檔、寫入及計算雜湊皆交給執行緒，事件迴圈只負責接收資料
+                f = await self._run(part.open, "wb")
+                async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        logger.debug(f"Backup skipped (too large) | {message_id}_{idx}")
+                        await self._run(self._discard_part, f, part)
+                        return
+                    await self._run(self._write_chunk, f, digest, chunk)
+            await self._run(f.close)
+        except BaseException:
+            if f is not None:
+                f.close()
+            part.unlink(missing_ok=True)
+            raise
+
+        if message_id in self._removed:
+            await self._run(part.unlink)
+            return
+        file = await self._run(
+            self._add_part, message_id, idx, part, digest.hexdigest(), ext, size
+        )
+        # 索引只在事件迴圈內修改
+        self._track(message_id, file, size)
+        # 寫入期間訊息被移除
+        if message_id in self._removed:
+            await self.remove(message_id)
+            return
+
+        if self.phash_index is not None:
+            await self.phash_index.add_file(
+                self.path(file), "backup", message_id=message_id, **meta
+            )
+
+    async def remove(self, *message_ids: int) -> Tuple[int, int]:
+        """移除訊息的備份，沒有其他訊息引用的檔案會一併刪除
+
+        回傳刪除的 (檔案數, 位元組數)
+        """
+        # 尚在下載的附件完成後不再保存
+        self._removed.update(
+            message_id for message_id in message_ids if message_id in self._pending
+        )
+        files = [
+            (message_id, self._index.pop(message_id))
+            for message_id in message_ids
+            if message_id in self._index
+        ]
+        if not files:
+            return 0, 0
+
+        freed, freed_bytes = [], 0
+        for _, message_files in files:
+            for file in message_files:
+                self._refs[file.hash] -= 1
+                if self._refs[file.hash] <= 0:
+                    del self._refs[file.hash]
+                    freed.append(file)
+                    freed_bytes += self._sizes.pop(file.hash)
+        self.used_bytes -= freed_bytes
+        await self._run(self._release, files)
+        # 檔案已刪除，相似圖片索引內指向該檔案的記錄一併移除
+        if self.phash_index is not None and freed:
+            await self.phash_index.remove(
+                "backup", [str(self.path(file)) for file in freed]
+            )
+        return len(freed), freed_bytes
+
+    async def sweep(self, max_age: float, max_bytes: int) -> Tuple[int, int]:
+        """移除超過保存期限 (秒) 的備份，並由最舊的訊息開始移除至總容量低於上限
+
+        回傳刪除的 (檔案數, 位元組數)
+        """
+        # 訊息 ID 為 snowflake，排序即為時間順序
+        cutoff = int((time.time() * 1000 - _DISCORD_EPOCH - max_age * 1000)) << 22
+        expired = []
+        remaining = self.used_bytes
+        # 估計每則訊息移除後可釋放的空間，計算需要移除多少則訊息
+        refs = dict(self._refs)
+        for message_id in sorted(self._index):
+            if message_id >= cutoff and remaining <= max_bytes:
+                break
+            expired.append(message_id)
+            for file in self._index[message_id]:
+                refs[file.hash] -= 1
+                if refs[file.hash] <= 0:
+                    remaining -= self._sizes[file.hash]
+
+        freed_files, freed_bytes = await self.remove(*expired)
+        self.evicted_files += freed_files
+        self.evicted_bytes += freed_bytes
+        if freed_files:
+            logger.info(
+                f"Backup swept | {len(expired)} messages, {freed_files} files"
+                f", {freed_bytes / 1048576:.1f} MiB"
+            )
+        return freed_files, freed_bytes
+
+    def summary(self) -> List[str]:
+        return [
+            f"{len(self._index)} messages, {len(self._refs)} files"
+            f", {self.used_bytes / 1048576:.1f} MiB used",
+            f"Evicted since start: {self.evicted_files} files"
+            f", {self.evicted_bytes / 1048576:.1f} MiB",
+            f"Downloads: {self._queue.qsize()} queued"
+            f", {self.skipped_downloads} skipped (queue full)",
+        ]
+
+    def _migrate_legacy(self) -> None:
+        """將舊版命名的備份檔轉為內容定址存放"""
+        migrated = 0
+        for legacy in self.folder.iterdir():
+            match = _LEGACY_NAME.match(legacy.name)
+            if match is None:
+                continue
+
+            message_id, idx, ext = int(match[1]), int(match[2]), match[3].lower()
+            if not any(file.idx == idx for file in self.files(message_id)):
+                data = legacy.read_bytes()
+                self._track(
+                    message_id, self._add(message_id, idx, data, ext), len(data)
+                )
+            legacy.unlink()
+            migrated += 1
+
+        if migrated:
+            logger.info(f"Migrated {migrated} legacy backup files")
+
+    def _remove_unreferenced(self) -> None:
+        """移除不在索引內的備份檔 (例如相同內容曾以不同副檔名另存的檔案)"""
+        stored = {
+            file.name
+            for message_files in self._index.values()
+            for file in message_files
+        }
+        removed = 0
+        for path in self.folder.iterdir():
+            if _BLOB_NAME.match(path.name) and path.name not in stored:
+                path.unlink()
+                removed += 1
+
+        if removed:
+            logger.info(f"Removed {removed} unreferenced backup files")
+
+    def start_phash_backfill(self) -> None:
+        """在背景將尚未加入相似圖片索引的既有備份加入索引，只會執行一次"""
+        if self.phash_index is None or self._backfill is not None:
+            return
+        self._backfill = asyncio.create_task(self._backfill_phashes())
+
+    async def _backfill_phashes(self) -> None:
+        # 以檔案路徑判斷是否已加入，中途關閉時下次啟動會接續進行
+        indexed = await self.phash_index.refs("backup")
+        files = [
+            (message_id, file)
+            for message_id, message_files in sorted(self._index.items())
+            for file in message_files
+            if str(self.path(file)) not in indexed
+        ]
+        if not files:
+            return
+
+        logger.info(f"Phash backfill started | {len(files)} files")
+        for message_id, file in files:
+            # 期間已被移除的備份略過
+            if file not in self.files(message_id):
+                continue
+            await self.phash_index.add_file(
+                self.path(file),
+                "backup",
+                message_id=message_id,
+                # 以訊息建立時間記錄，與下載當下記錄的圖片一致
+                created_at=((message_id >> 22) + _DISCORD_EPOCH) / 1000,
+            )
+        logger.info(f"Phash backfill finished | {len(files)} files")
+
+    async def close(self) -> None:
+        tasks = self._workers + ([self._backfill] if self._backfill else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+        self._executor.shutdown(wait=True)
+        self._db.close()
@@ -9,3 +9,7 @@ __all__ = [
 class CogInit(commands.Cog):
     def __init__(self, bot: ItkBot) -> None:
         self.bot = bot
+
+    async def cog_close(self) -> None:
+        """機器人關閉前呼叫，用於寫回尚未儲存的資料"""
+        pass
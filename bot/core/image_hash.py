@@ -0,0 +1,29 @@
+import io
+
+from PIL import Image
+
+__all__ = [
+    "dhash",
+]
+
+
+def dhash(data: bytes, size: int = 8) -> int:
+    """計算圖片的差異雜湊 (dHash)，重新壓縮或縮放的圖片會得到相同或相近的值
+
+    將圖片轉為灰階並縮小為 (size + 1) x size，比較每列相鄰像素的明暗，
+    得到 size * size 位元的整數。
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG 可直接以較低解析度解碼，大幅減少解碼時間
+        img.draft("L", (size * 8, size * 8))
+        pixels = list(
+            img.convert("L").resize((size + 1, size), Image.LANCZOS).getdata()
+        )
+
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
@@ -0,0 +1,134 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from pytz import timezone
+
+__all__ = [
+    "ApiKeyPool",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class _KeyState:
+    __slots__ = (
+        "used",
+        "successes",
+        "failures",
+        "consecutive_failures",
+        "benched_until",
+    )
+
+    def __init__(self) -> None:
+        self.used = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.benched_until = 0.0
+
+
+class ApiKeyPool:
+    """依剩餘配額挑選 API 金鑰，配額用盡或失效的金鑰暫停使用至配額重置
+
+    配額以每日重置時間 (`reset_tz` 時區的午夜) 為界計算，
+    每次取得金鑰即計入一次用量。
+    """
+
+    # 視為配額用盡或金鑰無效的 HTTP 狀態碼
+    QUOTA_STATUSES = (403, 429)
+
+    def __init__(
+        self,
+        keys: Iterable[str],
+        daily_quota: int,
+        reset_tz: str = "America/Los_Angeles",
+        max_failures: int = 3,
+        cooldown: float = 300,
+    ) -> None:
+        self.daily_quota = daily_quota
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+        self._tz = timezone(reset_tz)
+        # 去除未設定的金鑰，並保留原有順序
+        self._keys: Dict[str, _KeyState] = {key: _KeyState() for key in keys if key}
+        self._reset_at = self._next_reset()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _next_reset(self) -> float:
+        now = datetime.now(self._tz)
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        # pytz 的時區須以 localize 套用，才會使用當日正確的 UTC 偏移
+        return self._tz.localize(midnight).timestamp()
+
+    def _roll_over(self) -> None:
+        if time.time() < self._reset_at:
+            return
+        for state in self._keys.values():
+            state.used = 0
+            state.consecutive_failures = 0
+            state.benched_until = 0.0
+        self._reset_at = self._next_reset()
+        logger.info("API key quota reset")
+
+    def acquire(self) -> Optional[str]:
+        """取得剩餘配額最多的可用金鑰，沒有可用金鑰時回傳 None"""
+        self._roll_over()
+        now = time.time()
+        available = [
+            (key, state)
+            for key, state in self._keys.items()
+            if state.benched_until <= now and state.used < self.daily_quota
+        ]
+        if not available:
+            return None
+
+        key, state = min(available, key=lambda item: item[1].used)
+        state.used += 1
+        return key
+
+    def report_success(self, key: str) -> None:
+        state = self._keys[key]
+        state.successes += 1
+        state.consecutive_failures = 0
+
+    def report_failure(self, key: str, status: Optional[int] = None) -> None:
+        state = self._keys[key]
+        state.failures += 1
+        state.consecutive_failures += 1
+
+        if status in self.QUOTA_STATUSES:
+            # 配額用盡，暫停至下次重置
+            state.benched_until = self._reset_at
+            logger.warning(f"API key {self._mask(key)} benched until quota reset")
+        elif state.consecutive_failures >= self.max_failures:
+            state.benched_until = time.time() + self.cooldown
+            logger.warning(
+                f"API key {self._mask(key)} benched for {self.cooldown}s"
+                f" after {state.consecutive_failures} failures"
+            )
+
+    @staticmethod
+    def _mask(key: str) -> str:
+        return f"{key[:4]}…{key[-4:]}"
+
+    def summary(self) -> List[str]:
+        self._roll_over()
+        now = time.time()
+        reset_in = timedelta(seconds=int(self._reset_at - now))
+        lines = [f"Quota resets in {reset_in}"]
+        for key, state in self._keys.items():
+            status = "available"
+            if state.used >= self.daily_quota:
+                status = f"exhausted {reset_in}"
+            elif state.benched_until > now:
+                status = f"benched {timedelta(seconds=int(state.benched_until - now))}"
+            lines.append(
+                f"{self._mask(key)}: {state.used}/{self.daily_quota} used, "
+                f"{state.successes} ok, {state.failures} failed, {status}"
+            )
+        return lines
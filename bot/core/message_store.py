@@ -0,0 +1,107 @@
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Tuple
+
+import discord
+
+__all__ = [
+    "MessageRecord",
+    "MessageStore",
+]
+
+
+class MessageRecord:
+    """刪除或編輯訊息時記錄所需的最少資訊"""
+
+    __slots__ = (
+        "id",
+        "author_id",
+        "author_name",
+        "channel_id",
+        "content",
+        "attachments",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        author_id: int,
+        author_name: str,
+        channel_id: int,
+        content: str,
+        attachments: Tuple[str, ...] = (),
+    ) -> None:
+        self.id = id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.channel_id = channel_id
+        self.content = content
+        # 附件檔名，依附件序號排列
+        self.attachments = attachments
+
+    @classmethod
+    def from_message(cls, msg: discord.Message) -> "MessageRecord":
+        return cls(
+            msg.id,
+            msg.author.id,
+            msg.author.display_name,
+            msg.channel.id,
+            msg.content,
+            tuple(att.filename for att in msg.attachments),
+        )
+
+    @property
+    def created_at(self) -> datetime:
+        # 建立時間可由 snowflake 推得，不另外保存
+        return discord.utils.snowflake_time(self.id)
+
+    def size(self) -> int:
+        """估計記錄佔用的記憶體"""
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.author_name)
+            + sys.getsizeof(self.content)
+            + sys.getsizeof(self.attachments)
+            + sum(sys.getsizeof(name) for name in self.attachments)
+        )
+
+
+class MessageStore:
+    """以記憶體用量為上限保存最近的訊息記錄，超過時移除最舊的記錄
+
+    discord.py 的訊息快取以則數為上限，超出快取的訊息被刪除或編輯時，
+    只會觸發 raw 事件而沒有原始內容，改由此處的記錄補上。
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._records: "OrderedDict[int, Tuple[MessageRecord, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._records
+
+    def add(self, record: MessageRecord) -> None:
+        self.pop(record.id)
+
+        size = record.size()
+        self._records[record.id] = (record, size)
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._records.popitem(last=False)
+            self.used_bytes -= evicted_size
+
+    def get(self, message_id: int) -> Optional[MessageRecord]:
+        item = self._records.get(message_id)
+        return item[0] if item is not None else None
+
+    def pop(self, message_id: int) -> Optional[MessageRecord]:
+        item = self._records.pop(message_id, None)
+        if item is None:
+            return None
+        self.used_bytes -= item[1]
+        return item[0]
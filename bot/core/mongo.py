@@ -1,31 +1,270 @@
-import os
-from typing import Any, Dict, Optional
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import pymongo
+from pymongo.collection import Collection, ReturnDocument
+
+from bot.configs import Bot
 
 __all__ = [
     "Mongo",
+    "MongoPool",
+    "MongoStats",
 ]
 
+logger = logging.getLogger(__name__)
+
+
+def _query_shape(query: Any) -> Any:
+    """將查詢中的值替換為型別名稱，只保留查詢的結構"""
+    if isinstance(query, dict):
+        return {k: _query_shape(v) for k, v in query.items()}
+    if isinstance(query, (list, tuple)):
+        # 批次操作只記錄數量，避免整批寫入被印出
+        if len(query) > 3:
+            return f"[{len(query)} items]"
+        return [_query_shape(v) for v in query]
+    return type(query).__name__
+
+
+class MongoStats:
+    """以 (collection, 操作) 分類統計 Mongo 操作的次數、錯誤及延遲分布"""
+
+    # 延遲分布的各區間上限 (ms)，最後一格為超過最大上限者
+    BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+    def __init__(self) -> None:
+        self._ops = defaultdict(
+            lambda: {
+                "count": 0,
+                "errors": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "histogram": [0] * (len(self.BUCKETS) + 1),
+            }
+        )
+
+    def record(
+        self, coll: str, op: str, elapsed_ms: float, query: Any, error: bool
+    ) -> None:
+        stats = self._ops[(coll, op)]
+        stats["count"] += 1
+        stats["errors"] += error
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["histogram"][bisect_left(self.BUCKETS, elapsed_ms)] += 1
+
+        if elapsed_ms >= Bot.mongo_options.slow_op_ms:
+            logger.warning(
+                f"Slow Mongo op | {coll}.{op} took {elapsed_ms:.1f}ms"
+                f" | {_query_shape(query)}"
+            )
+
+    def percentile(self, coll: str, op: str, p: float) -> float:
+        """由延遲分布估計百分位數，回傳該區間的上限 (ms)"""
+        stats = self._ops[(coll, op)]
+        target = stats["count"] * p
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (float("inf"),), stats["histogram"]):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def summary(self) -> List[str]:
+        lines = []
+        for (coll, op), stats in sorted(self._ops.items()):
+            avg_ms = stats["total_ms"] / stats["count"] if stats["count"] else 0
+            lines.append(
+                f"{coll}.{op}: {stats['count']} ops, {stats['errors']} errors, "
+                f"avg {avg_ms:.1f}ms, p95 <= {self.percentile(coll, op, 0.95)}ms, "
+                f"max {stats['max_ms']:.1f}ms"
+            )
+        return lines
+
+    def reset(self) -> None:
+        self._ops.clear()
+
 
 class Mongo:
-    def __init__(self, db: str, coll: str, *args, **kwargs) -> None:
-        self._client = pymongo.MongoClient(os.getenv("MONGO_HOST"))
-        self._db = self._client[db]
-        self._coll = self._db[coll]
+    def __init__(
+        self,
+        coll: Collection,
+        executor: ThreadPoolExecutor,
+        stats: MongoStats,
+        *args,
+        timeout: Optional[float] = None,
+        **kwargs,
+    ) -> None:
+        self._coll = coll
+        self._executor = executor
+        self._stats = stats
+
+        self._timeout = timeout if timeout is not None else Bot.mongo_options.timeout
+
+    async def _run(
+        self, op: str, query: Any, func: Callable[..., Any], *args, **kwargs
+    ) -> Any:
+        """於執行緒池內執行同步的 pymongo 呼叫，超過時限則拋出 asyncio.TimeoutError"""
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        error = False
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._executor, partial(func, *args, **kwargs)),
+                timeout=self._timeout,
+            )
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._stats.record(
+                self._coll.name,
+                op,
+                (time.perf_counter() - start_time) * 1000,
+                query,
+                error,
+            )
 
-    def find(self, query: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    async def find(
+        self, query: Optional[Dict[str, Any]] = None
+    ) -> Union[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
         if query:
-            return self._coll.find_one(query)
-        return self._coll.find()
+            return await self._run("find_one", query, self._coll.find_one, query)
+        # Cursor 迭代時才會進行 I/O，因此在執行緒內直接轉為串列
+        return await self._run("find", {}, lambda: list(self._coll.find()))
 
-    def update(
+    async def update(
         self,
         query: Dict[str, Any],
         data: Dict[str, Dict[str, Any]],
         upsert: bool = True,
     ) -> None:
-        self._coll.update_one(query, data, upsert=upsert)
+        await self._run(
+            "update_one", query, self._coll.update_one, query, data, upsert=upsert
+        )
+
+    async def find_and_update(
+        self,
+        query: Dict[str, Any],
+        data: Dict[str, Dict[str, Any]],
+        upsert: bool = True,
+        return_updated: bool = False,
+    ) -> Optional[Dict[str, Any]]:
+        """更新單一文件，並回傳更新前（或更新後）的文件"""
+        return await self._run(
+            "find_one_and_update",
+            query,
+            self._coll.find_one_and_update,
+            query,
+            data,
+            upsert=upsert,
+            return_document=(
+                ReturnDocument.AFTER if return_updated else ReturnDocument.BEFORE
+            ),
+        )
+
+    async def delete(self, query: Dict[str, Any]) -> None:
+        await self._run("delete_one", query, self._coll.delete_one, query)
+
+    async def find_page(
+        self,
+        query: Optional[Dict[str, Any]] = None,
+        sort: Optional[List[Tuple[str, int]]] = None,
+        skip: int = 0,
+        limit: int = 0,
+    ) -> List[Dict[str, Any]]:
+        def _find_page() -> List[Dict[str, Any]]:
+            cursor = self._coll.find(query or {}, skip=skip, limit=limit)
+            if sort:
+                cursor = cursor.sort(sort)
+            return list(cursor)
+
+        return await self._run("find_page", query or {}, _find_page)
+
+    async def count(self, query: Optional[Dict[str, Any]] = None) -> int:
+        return await self._run(
+            "count_documents", query or {}, self._coll.count_documents, query or {}
+        )
+
+    async def create_index(self, keys: List[Tuple[str, int]], **kwargs) -> str:
+        return await self._run(
+            "create_index", keys, self._coll.create_index, keys, **kwargs
+        )
+
+    async def aggregate(self, pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return await self._run(
+            "aggregate", pipeline, lambda: list(self._coll.aggregate(pipeline))
+        )
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = False) -> None:
+        if not requests:
+            return
+        await self._run(
+            "bulk_write",
+            requests,
+            self._coll.bulk_write,
+            requests,
+            ordered=ordered,
+        )
+
+
+class MongoPool:
+    """整個程序共用的 MongoClient，依 database / collection 發放 Mongo 物件"""
+
+    def __init__(self) -> None:
+        self._client: Optional[pymongo.MongoClient] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._handles: Dict[Tuple[str, str], Mongo] = {}
+
+        self.stats = MongoStats()
+
+    @property
+    def client(self) -> pymongo.MongoClient:
+        # 第一次使用時才建立連線，避免沒用到資料庫時也進行握手
+        if self._client is None:
+            options = Bot.mongo_options
+            self._client = pymongo.MongoClient(
+                Bot.mongo_host,
+                maxPoolSize=options.max_pool_size,
+                minPoolSize=options.min_pool_size,
+                maxIdleTimeMS=options.max_idle_time_ms,
+                serverSelectionTimeoutMS=options.server_selection_timeout_ms,
+            )
+            self._executor = ThreadPoolExecutor(
+                max_workers=options.executor_workers,
+                thread_name_prefix="mongo",
+            )
+            logger.info(
+                f"Mongo client created | pool size {options.min_pool_size}"
+                f" ~ {options.max_pool_size}"
+            )
+        return self._client
+
+    def get(self, db: str, coll: str) -> Mongo:
+        key = (db, coll)
+        if key not in self._handles:
+            self._handles[key] = Mongo(
+                self.client[db][coll], self._executor, self.stats
+            )
+        return self._handles[key]
+
+    def close(self) -> None:
+        if self._client is None:
+            return
+
+        for line in self.stats.summary():
+            logger.info(f"Mongo stats | {line}")
 
-    def delete(self, query: Dict[str, Any]) -> None:
-        self._coll.delete_one(query)
+        self._handles.clear()
+        self._client.close()
+        self._executor.shutdown(wait=False)
+        self._client = None
+        self._executor = None
+        logger.info("Mongo client closed")
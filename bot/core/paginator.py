@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import discord
+
+from bot.configs import Reactions
+from bot.core.cache import TTLCache
+
+__all__ = [
+    "PageState",
+    "Paginator",
+]
+
+logger = logging.getLogger(__name__)
+
+PageFactory = Callable[[int], Awaitable[discord.Embed]]
+
+
+class PageState:
+    """單一分頁訊息的狀態，頁面 Embed 產生一次後即保留"""
+
+    __slots__ = ("channel", "pages", "factory", "current", "jump", "lock")
+
+    def __init__(
+        self,
+        channel: discord.abc.Messageable,
+        pages: List[Optional[discord.Embed]],
+        factory: Optional[PageFactory] = None,
+        current: int = 0,
+        jump: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.channel = channel
+        # 尚未產生的頁面為 None，需要時由 factory 產生
+        self.pages = pages
+        self.factory = factory
+        self.current = current
+        # 反應表符 -> 直接跳至的頁面
+        self.jump = jump
+        self.lock = asyncio.Lock()
+
+    @property
+    def total(self) -> int:
+        return len(self.pages)
+
+    async def page(self, index: int) -> discord.Embed:
+        if self.pages[index] is None:
+            self.pages[index] = await self.factory(index)
+        return self.pages[index]
+
+    def target(self, emoji: str) -> Optional[int]:
+        """依反應表符決定要前往的頁面，無效的表符回傳 None"""
+        if self.jump is not None:
+            return self.jump.get(emoji)
+
+        last = self.total - 1
+        if emoji == Reactions.first_page:
+            return 0
+        if emoji == Reactions.prev_page:
+            return max(self.current - 1, 0)
+        if emoji == Reactions.next_page:
+            return min(self.current + 1, last)
+        if emoji == Reactions.last_page:
+            return last
+        return None
+
+
+class Paginator:
+    """所有分頁訊息共用的狀態表，以訊息 ID 查詢狀態
+
+    狀態存放在具存活時間及數量上限的 TTLCache，訊息沒有被刪除也不會無限增長；
+    過期的訊息不再回應翻頁。
+    """
+
+    NAVIGATION = ("first_page", "prev_page", "next_page", "last_page")
+
+    def __init__(self, bot: discord.Client, maxsize: int, ttl: float) -> None:
+        self.bot = bot
+        self._states = TTLCache(maxsize, ttl)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._states
+
+    def register(
+        self,
+        message: discord.Message,
+        pages: Optional[List[Optional[discord.Embed]]] = None,
+        *,
+        total: Optional[int] = None,
+        factory: Optional[PageFactory] = None,
+        current: int = 0,
+        jump: Optional[Dict[str, int]] = None,
+    ) -> PageState:
+        """登記分頁訊息
+
+        傳入 `pages` 時使用預先產生的頁面 (之後仍可附加)；否則以 `factory`
+        產生 `total` 頁中尚未產生的頁面，`pages` 可只填入已產生的部分。
+        """
+        if pages is None:
+            pages = []
+        if total is not None and len(pages) < total:
+            pages = pages + [None] * (total - len(pages))
+
+        state = PageState(message.channel, pages, factory, current, jump)
+        self._states[message.id] = state
+        self.bot.reactions.register_message(message.id, self.on_reaction)
+        return state
+
+    def get(self, message_id: int) -> Optional[PageState]:
+        return self._states.get(message_id)
+
+    def discard(self, message_id: int) -> None:
+        self._states.pop(message_id)
+        self.bot.reactions.unregister_message(message_id)
+
+    @staticmethod
+    async def add_navigation(message: discord.Message) -> None:
+        for name in Paginator.NAVIGATION:
+            await message.add_reaction(Reactions[name])
+
+    async def on_reaction(self, payload: discord.RawReactionActionEvent) -> bool:
+        """處理分頁訊息上的反應，回傳此訊息是否為分頁訊息"""
+        state = self._states.get(payload.message_id)
+        if state is None:
+            return False
+        # 忽略機器人的反應
+        if payload.user_id == self.bot.user.id or (
+            payload.member is not None and payload.member.bot
+        ):
+            return True
+
+        message = state.channel.get_partial_message(payload.message_id)
+
+        try:
+            await message.remove_reaction(
+                payload.emoji, discord.Object(payload.user_id)
+            )
+        except discord.HTTPException:
+            pass
+
+        async with state.lock:
+            target = state.target(str(payload.emoji))
+            if target is None or target >= state.total or target == state.current:
+                return True
+
+            state.current = target
+            try:
+                await message.edit(embed=await state.page(target))
+            except discord.NotFound:
+                self.discard(payload.message_id)
+        return True
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Union
+
+import numpy as np
+
+from bot.core.image_hash import dhash
+
+__all__ = [
+    "PhashIndex",
+]
+
+logger = logging.getLogger(__name__)
+
+# 0 ~ 255 各自的位元數，用於計算漢明距離
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    id         INTEGER PRIMARY KEY,
+    hash       INTEGER NOT NULL,
+    source     TEXT    NOT NULL,
+    ref        TEXT    NOT NULL,
+    guild_id   INTEGER,
+    channel_id INTEGER,
+    message_id INTEGER,
+    author_id  INTEGER,
+    created_at REAL    NOT NULL
+);
+"""
+
+
+def _to_signed(value: int) -> int:
+    # SQLite 的整數為有號 64 位元
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class PhashIndex:
+    """以 dHash 記錄出現過的圖片，並以漢明距離找出相近的圖片
+
+    所有雜湊值以 uint64 陣列保存在記憶體內，查詢時以 NumPy 一次計算與全部雜湊的
+    距離；其餘資訊保存在 SQLite，只在取出查詢結果時讀取。
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="phash")
+
+        rows = self._db.execute("SELECT id, hash FROM hashes ORDER BY id").fetchall()
+        # 預留空間，新增時不需每次重新配置陣列
+        capacity = max(len(rows) * 2, 1024)
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._size = len(rows)
+        if rows:
+            ids, hashes = zip(*rows)
+            self._ids[: self._size] = ids
+            self._hashes[: self._size] = np.array(hashes, dtype=np.int64).view(
+                np.uint64
+            )
+        logger.info(f"Phash index loaded | {self._size} images")
+
+    def __len__(self) -> int:
+        return self._size
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _append(self, row_id: int, value: int) -> None:
+        if self._size == len(self._hashes):
+            self._hashes = np.resize(self._hashes, self._size * 2)
+            self._ids = np.resize(self._ids, self._size * 2)
+        self._hashes[self._size] = value
+        self._ids[self._size] = row_id
+        self._size += 1
+
+    def _insert(self, value: int, record: Dict[str, Any]) -> int:
+        with self._db:
+            cursor = self._db.execute(
+                "INSERT INTO hashes (hash, source, ref, guild_id, channel_id,"
+                " message_id, author_id, created_at)"
+                " VALUES (:hash, :source, :ref, :guild_id, :channel_id,"
+                " :message_id, :author_id, :created_at)",
+                {"hash": _to_signed(value), "created_at": time.time(), **record},
+            )
+        return cursor.lastrowid
+
+    async def add(
+        self,
+        value: int,
+        source: str,
+        ref: str,
+        guild_id: Optional[int] = None,
+        channel_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+        author_id: Optional[int] = None,
+        created_at: Optional[float] = None,
+    ) -> None:
+        """記錄一次圖片出現，source 為來源種類 (`backup`、`search`)，ref 為檔案或網址
+
+        created_at 預設為現在時間
+        """
+        record = {
+            "source": source,
+            "ref": ref,
+            "guild_id": guild_id,
+            "channel_id": channel_id,
+            "message_id": message_id,
+            "author_id": author_id,
+        }
+        if created_at is not None:
+            record["created_at"] = created_at
+        row_id = await self._run(self._insert, value, record)
+        # 陣列只在事件迴圈內修改
+        self._append(row_id, value)
+
+    async def add_file(self, path: Union[str, Path], source: str, **kwargs) -> None:
+        """計算檔案的 dHash 並記錄，無法解析的圖片略過"""
+        try:
+            value = await self._run(lambda: dhash(Path(path).read_bytes()))
+        except Exception:
+            logger.debug(f"Failed to hash {path}")
+            return
+        await self.add(value, source, str(path), **kwargs)
+
+    def _delete(self, source: str, refs: List[str]) -> List[int]:
+        ids = []
+        with self._db:
+            # 分批查詢，避免超過 SQLite 的參數數量上限
+            for i in range(0, len(refs), 500):
+                batch = refs[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                ids += [
+                    row_id
+                    for (row_id,) in self._db.execute(
+                        f"SELECT id FROM hashes WHERE source = ?"
+                        f" AND ref IN ({placeholders})",
+                        (source, *batch),
+                    )
+                ]
+                self._db.execute(
+                    f"DELETE FROM hashes WHERE source = ? AND ref IN ({placeholders})",
+                    (source, *batch),
+                )
+        return ids
+
+    async def remove(self, source: str, refs: List[str]) -> int:
+        """移除指定來源中 ref 符合的所有記錄，回傳移除的數量"""
+        ids = await self._run(self._delete, source, refs)
+        if ids:
+            # 陣列只在事件迴圈內修改，保留其餘雜湊並維持原有順序
+            keep = np.flatnonzero(~np.isin(self._ids[: self._size], ids))
+            self._hashes[: len(keep)] = self._hashes[keep]
+            self._ids[: len(keep)] = self._ids[keep]
+            self._size = len(keep)
+        return len(ids)
+
+    async def refs(self, source: str) -> Set[str]:
+        """回傳指定來源已記錄的所有 ref"""
+        rows = await self._run(
+            lambda: self._db.execute(
+                "SELECT DISTINCT ref FROM hashes WHERE source = ?", (source,)
+            ).fetchall()
+        )
+        return {ref for (ref,) in rows}
+
+    def _rows(self, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        cursor = self._db.cursor()
+        cursor.row_factory = sqlite3.Row
+        rows = cursor.execute(
+            f"SELECT * FROM hashes WHERE id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall()
+        return {row["id"]: dict(row) for row in rows}
+
+    async def search(
+        self, value: int, max_distance: int, limit: int = 10
+    ) -> List[Dict[str, Any]]:
+        """找出距離不超過 max_distance 的圖片，依距離及時間由近到遠排列
+
+        回傳的記錄另含 `distance` 欄位
+        """
+        hashes = self._hashes[: self._size]
+        xor = hashes ^ np.uint64(value)
+        distances = _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+        matched = np.flatnonzero(distances <= max_distance)
+        # 距離相同時，較新的記錄優先
+        order = np.lexsort((-self._ids[matched], distances[matched]))[:limit]
+        matched = matched[order]
+        if not len(matched):
+            return []
+
+        ids = self._ids[matched].tolist()
+        rows = await self._run(self._rows, ids)
+        return [
+            {**rows[row_id], "distance": int(distance)}
+            for row_id, distance in zip(ids, distances[matched].tolist())
+            if row_id in rows
+        ]
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._db.close()
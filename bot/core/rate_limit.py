@@ -0,0 +1,38 @@
+import asyncio
+import time
+from collections import deque
+
+__all__ = [
+    "SlidingWindowLimiter",
+]
+
+
+class SlidingWindowLimiter:
+    """限制任意 `window` 秒內最多進行 `limit` 次請求，額度用完時等待最舊的請求過期"""
+
+    def __init__(self, limit: int, window: float) -> None:
+        self.limit = limit
+        self.window = window
+        self._calls: "deque[float]" = deque()
+        self._lock = asyncio.Lock()
+
+    def _prune(self, now: float) -> None:
+        while self._calls and self._calls[0] <= now - self.window:
+            self._calls.popleft()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._prune(now)
+                if len(self._calls) < self.limit:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self._calls[0] + self.window - now)
+
+    def exhaust(self) -> None:
+        """伺服器回報額度已用完時，將目前的時間窗填滿"""
+        now = time.monotonic()
+        self._prune(now)
+        while len(self._calls) < self.limit:
+            self._calls.append(now)
@@ -0,0 +1,40 @@
+import logging
+from typing import Any, Awaitable, Callable
+
+import discord
+
+from bot.core.cache import TTLCache
+
+__all__ = [
+    "ReactionDispatcher",
+]
+
+logger = logging.getLogger(__name__)
+
+ReactionHandler = Callable[[discord.RawReactionActionEvent], Awaitable[Any]]
+
+
+class ReactionDispatcher:
+    """依訊息 ID 分派反應事件，每個事件只需一次 dict 查詢
+
+    登記存放在具存活時間及數量上限的 TTLCache，不需要手動移除。
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._by_message = TTLCache(maxsize, ttl)
+
+    def register_message(self, message_id: int, handler: ReactionHandler) -> None:
+        self._by_message[message_id] = handler
+
+    def unregister_message(self, message_id: int) -> None:
+        self._by_message.pop(message_id)
+
+    async def dispatch(self, payload: discord.RawReactionActionEvent) -> None:
+        handler = self._by_message.get(payload.message_id)
+        if handler is None:
+            return
+
+        try:
+            await handler(payload)
+        except Exception:
+            logger.exception(f"Reaction handler failed | {payload.message_id}")
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Optional, Tuple, Union
+
+__all__ = [
+    "SQLiteCache",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key        TEXT PRIMARY KEY,
+    value      TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at);
+"""
+
+
+class SQLiteCache:
+    """保存在本機 SQLite 的鍵值快取，值以 JSON 儲存，超過存活時間的項目視為不存在
+
+    同一個值可以對應多個鍵，所有讀寫皆在單一執行緒內進行，不阻塞事件迴圈。
+    """
+
+    def __init__(self, path: Union[str, Path], ttl: float) -> None:
+        self.ttl = ttl
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache")
+        self._purge()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _purge(self) -> None:
+        with self._db:
+            self._db.execute(
+                "DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl,)
+            )
+
+    def _get(self, key: str) -> Optional[Tuple[Any, float]]:
+        row = self._db.execute(
+            "SELECT value, created_at FROM cache WHERE key = ? AND created_at >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """回傳 (值, 寫入時間)，不存在或已過期時回傳 None"""
+        return await self._run(self._get, key)
+
+    def _set(self, keys: Iterable[str], value: Any, created_at: float) -> None:
+        dumped = json.dumps(value, ensure_ascii=False)
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                ((key, dumped, created_at) for key in keys),
+            )
+        self._purge()
+
+    async def set(
+        self, keys: Iterable[str], value: Any, created_at: Optional[float] = None
+    ) -> None:
+        """以所有鍵保存同一個值，可指定原始寫入時間以沿用既有項目的存活時間"""
+        await self._run(
+            self._set, list(keys), value, created_at if created_at else time.time()
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._db.close()
@@ -0,0 +1,141 @@
+import re
+import sre_constants as sc
+import sre_parse
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+__all__ = [
+    "TriggerEngine",
+]
+
+# 字元集合大於此數量時，不再展開為首字元集合
+_MAX_RANGE_SIZE = 256
+
+
+class _CompiledTrigger(NamedTuple):
+    priority: int
+    pattern: re.Pattern
+    unless: Optional[re.Pattern]
+    # 所有可能的首字元，無法推得時為 None (需要完整比對)
+    first_chars: Optional[FrozenSet[str]]
+
+
+def _first_chars(items: Iterable[Any]) -> Optional[tuple[set[str], bool]]:
+    """推算正則所有可能的首字元，回傳 (字元集合, 是否可能為空字串)，無法推得則回傳 None"""
+    chars = set()
+    for op, av in items:
+        if op is sc.LITERAL:
+            chars.add(chr(av))
+            return chars, False
+        elif op is sc.IN:
+            for in_op, in_av in av:
+                if in_op is sc.LITERAL:
+                    chars.add(chr(in_av))
+                elif in_op is sc.RANGE and in_av[1] - in_av[0] <= _MAX_RANGE_SIZE:
+                    chars.update(chr(c) for c in range(in_av[0], in_av[1] + 1))
+                else:
+                    return None
+            return chars, False
+        elif op in (sc.AT, sc.ASSERT, sc.ASSERT_NOT):
+            # 錨點及前後查找不消耗字元
+            continue
+        elif op is sc.SUBPATTERN:
+            sub = _first_chars(av[-1])
+        elif op is sc.BRANCH:
+            subs = [_first_chars(branch) for branch in av[1]]
+            if any(sub is None for sub in subs):
+                return None
+            sub = (
+                set().union(*(sub[0] for sub in subs)),
+                any(sub[1] for sub in subs),
+            )
+        elif op in (sc.MAX_REPEAT, sc.MIN_REPEAT):
+            sub = _first_chars(av[2])
+            if sub is not None and av[0] == 0:
+                sub = (sub[0], True)
+        else:
+            return None
+
+        if sub is None:
+            return None
+        chars |= sub[0]
+        if not sub[1]:
+            return chars, False
+    return chars, True
+
+
+def _parse_first_chars(pattern: str) -> Optional[FrozenSet[str]]:
+    """回傳正則的首字元集合；可能比對到空字串或無法推得 (包含解析失敗) 時回傳 None"""
+    try:
+        first = _first_chars(sre_parse.parse(pattern))
+    except Exception:
+        return None
+    # 可能比對到空字串的規則必須完整比對
+    if first is None or first[1]:
+        return None
+    return frozenset(first[0])
+
+
+class TriggerEngine:
+    """依優先序排列的觸發規則，找出第一條符合的規則
+
+    每條規則為含有 `name`、`pattern` 及可選 `field` (預設為 `content`)、
+    `unless` (符合時視為不觸發) 的 dict。載入時編譯所有正則，並以各規則可能的首字元
+    組成單一字元集合；多數訊息不含任何首字元，掃描一次即可略過，其餘只比對首字元
+    出現在訊息中的規則。
+    """
+
+    def __init__(self, rules: Iterable[Dict[str, Any]]) -> None:
+        self.rules: List[Dict[str, Any]] = list(rules)
+
+        self._triggers: Dict[str, List[_CompiledTrigger]] = {}
+        for i, rule in enumerate(self.rules):
+            self._triggers.setdefault(rule.get("field", "content"), []).append(
+                _CompiledTrigger(
+                    priority=i,
+                    pattern=re.compile(rule["pattern"]),
+                    unless=re.compile(rule["unless"]) if rule.get("unless") else None,
+                    first_chars=_parse_first_chars(rule["pattern"]),
+                )
+            )
+
+        # 各欄位的首字元預篩，任一規則無法推得首字元時不預篩
+        self._prefilters: Dict[str, Optional[re.Pattern]] = {}
+        for field, triggers in self._triggers.items():
+            if any(t.first_chars is None for t in triggers):
+                self._prefilters[field] = None
+                continue
+            chars = sorted(set().union(*(t.first_chars for t in triggers)))
+            self._prefilters[field] = re.compile(
+                f"[{''.join(re.escape(c) for c in chars)}]"
+            )
+
+    def match(self, **fields: str) -> Optional[Dict[str, Any]]:
+        """回傳所有欄位中優先序最高的符合規則，沒有則回傳 None"""
+        best = len(self.rules)
+        for field, text in fields.items():
+            triggers = self._triggers.get(field)
+            if not triggers:
+                continue
+
+            prefilter = self._prefilters[field]
+            if prefilter is not None and prefilter.search(text) is None:
+                continue
+
+            present = set(text)
+            for trigger in triggers:
+                # 只需檢查優先序高於目前結果的規則
+                if trigger.priority >= best:
+                    break
+                if trigger.first_chars is not None and trigger.first_chars.isdisjoint(
+                    present
+                ):
+                    continue
+                if trigger.pattern.search(text) is None:
+                    continue
+                if trigger.unless is not None and trigger.unless.search(text):
+                    continue
+
+                best = trigger.priority
+                break
+
+        return self.rules[best] if best < len(self.rules) else None
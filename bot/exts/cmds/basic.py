@@ -87,6 +87,22 @@ class Basic(CogInit):
     async def ping(self, ctx: commands.Context) -> None:
         await ctx.reply(f"Pong? {round(self.bot.latency * 1000)}")
 
+    @commands.command(aliases=["mstats"])
+    async def mongo_stats(self, ctx: commands.Context, action: str = "") -> None:
+        if not (await self.bot.is_owner(ctx.author)):
+            return
+
+        if action == "reset":
+            self.bot.mongo.stats.reset()
+            await MessageUtils.reply_then_delete(ctx, "Mongo stats have been reset.", 5)
+            return
+
+        lines = self.bot.mongo.stats.summary() or ["No Mongo operation recorded yet."]
+        # 訊息長度上限為 2000 字
+        report = "\n".join(lines)[:1900]
+        await ctx.reply(f"```\n{report}\n```", delete_after=60)
+        await ctx.message.delete(delay=60)
+
 
 class NotAnAction(errors.ExtensionError):
     """使用者傳入意料之外的動作"""
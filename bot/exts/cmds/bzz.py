@@ -1,3 +1,6 @@
+import hashlib
+import hmac
+import logging
 import random
 from datetime import datetime as dt
 
@@ -6,17 +9,62 @@ from bot.configs import Fun
 from bot.core import CogInit
 from discord.ext import commands
 
+logger = logging.getLogger(__name__)
+
 
 class Bzz(CogInit):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        from bot.core import Mongo
-
-        self.mongo = Mongo("discord_669934356172636199", "tdbzz_record")
-
         self.bzz_options = Fun.bzz.options
         self.tdbzz_options = Fun.tdbzz.options
 
+        # hash: 由金鑰雜湊推算運勢，不需存取資料庫；mongo: 每日運勢記錄於 Mongo
+        self.tdbzz_mode = Fun.tdbzz.mode
+        self._tdbzz_secret = (Fun.tdbzz.secret or "").encode()
+        if self.tdbzz_mode == "hash" and not self._tdbzz_secret:
+            logger.warning("TDBZZ_SECRET is not set, daily fortunes are predictable")
+        # 只有 mongo 模式需要資料庫連線
+        self.mongo = None
+        if self.tdbzz_mode == "mongo":
+            self.mongo = self.bot.mongo.get(
+                "discord_669934356172636199", "tdbzz_record"
+            )
+            # 讓舊的每日紀錄自動過期
+            self.bot.loop.create_task(
+                self.mongo.create_index(
+                    [("created_at", 1)],
+                    expireAfterSeconds=Fun.tdbzz.record_ttl_days * 86400,
+                )
+            )
+
+    def _hashed_tdbzz(self, user_id: int, date: str) -> str:
+        digest = hmac.new(
+            self._tdbzz_secret, f"{user_id}:{date}".encode(), hashlib.sha256
+        ).digest()
+        return self.tdbzz_options[
+            int.from_bytes(digest[:8], "big") % len(self.tdbzz_options)
+        ]
+
+    async def _recorded_tdbzz(self, user_id: int, date: str) -> str:
+        record = await self.mongo.find({"_id": date})
+
+        if record is not None and str(user_id) in record:
+            return record[f"{user_id}"]
+
+        bzz_msg = random.choice(self.tdbzz_options)
+        await self.mongo.update(
+            {"_id": date},
+            {
+                "$set": {
+                    f"{user_id}": bzz_msg,
+                },
+                "$setOnInsert": {
+                    "created_at": dt.utcnow(),
+                },
+            },
+        )
+        return bzz_msg
+
     @commands.command()
     async def bzz(self, ctx: commands.Context) -> None:
         await ctx.reply(random.choice(self.bzz_options), delete_after=15)
@@ -25,21 +73,12 @@ class Bzz(CogInit):
     @commands.command()
     async def tdbzz(self, ctx: commands.Context) -> None:
         now = dt.now()
-        record = self.mongo.find({"_id": now.strftime("%Y-%m-%d")})
-
-        bzz_msg: str = ""
-        if record is None or str(ctx.author.id) not in record:
-            bzz_msg = random.choice(self.tdbzz_options)
-            self.mongo.update(
-                {"_id": now.strftime("%Y-%m-%d")},
-                {
-                    "$set": {
-                        f"{ctx.author.id}": bzz_msg,
-                    }
-                },
-            )
+        date = now.strftime("%Y-%m-%d")
+
+        if self.tdbzz_mode == "mongo":
+            bzz_msg = await self._recorded_tdbzz(ctx.author.id, date)
         else:
-            bzz_msg = record[f"{ctx.author.id}"]
+            bzz_msg = self._hashed_tdbzz(ctx.author.id, date)
 
         await ctx.reply(
             ctx.author.mention + f" 你今日（{now.strftime('%m / %d')}）的運勢為：" + bzz_msg,
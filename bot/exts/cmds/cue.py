@@ -3,30 +3,34 @@ from typing import Optional, Union
 
 import discord
 from bot import ItkBot
-from bot.configs import Reactions
-from bot.core import CogInit
+from bot.configs import Cmds
+from bot.core import CogInit, TTLCache
 from discord.ext import commands
 
 
 class Cue(CogInit):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        from bot.core import Mongo
+        self.mongo = self.bot.mongo.get("discord_669934356172636199", "cue_list")
 
-        self.mongo = Mongo("discord_669934356172636199", "cue_list")
+        # 成員 ID -> 語錄串列，寫入 Mongo 時同步更新
+        self._cue_cache = TTLCache(Cmds.cue.cache_size, Cmds.cue.cache_ttl)
 
-        self.cue_msg_details = []
-
-    def _get_member_cue_list(self, member: discord.Member) -> list[str]:
-        result = self.mongo.find({"_id": member.id})
-        return result["list"] if result is not None else []
-
-    def _get_updated_cue_embed(self) -> discord.Embed:
-        current_page = self.cue_msg_details[1]
-        total_page = self.cue_msg_details[2]
-        member_cue_list = self.cue_msg_details[3]
-        member = self.cue_msg_details[4]
+    async def _get_member_cue_list(self, member: discord.Member) -> list[str]:
+        member_cue_list = self._cue_cache.get(member.id)
+        if member_cue_list is None:
+            result = await self.mongo.find({"_id": member.id})
+            member_cue_list = result["list"] if result is not None else []
+            self._cue_cache[member.id] = member_cue_list
+        return member_cue_list
 
+    @staticmethod
+    def _get_cue_embed(
+        member: discord.Member,
+        member_cue_list: list[str],
+        current_page: int,
+        total_page: int,
+    ) -> discord.Embed:
         embed = discord.Embed()
         # Author
         embed.set_author(name=f"{member.display_name} 錯字大全")
@@ -42,48 +46,6 @@ class Cue(CogInit):
 
         return embed
 
-    @commands.Cog.listener()
-    async def on_message_delete(self, msg: discord.Message) -> None:
-        if not self.cue_msg_details or self.cue_msg_details[0] is None:
-            return
-
-        if msg == self.cue_msg_details[0]:
-            self.cue_msg_details = []
-
-    @commands.Cog.listener()
-    async def on_reaction_add(
-        self, reaction: discord.Reaction, user: discord.User
-    ) -> None:
-        # 忽略來自機器人的 Emoji 添加事件
-        if user.bot:
-            return
-        # 如果之前沒有列出語錄，或事件訊息不是語錄訊息，忽略
-        if not self.cue_msg_details or reaction.message != self.cue_msg_details[0]:
-            return
-        await reaction.remove(user)
-
-        details = self.cue_msg_details
-
-        # 上一頁
-        if str(reaction.emoji) == Reactions.prev_page:
-            # 避免頁數出現負值
-            if details[1] != 0:
-                details[1] -= 1
-        # 下一頁
-        elif str(reaction.emoji) == Reactions.next_page:
-            # 避免頁數超出總頁數
-            if details[1] != details[2]:
-                details[1] += 1
-        # 首頁
-        elif str(reaction.emoji) == Reactions.first_page:
-            details[1] = 0
-        # 末頁
-        elif str(reaction.emoji) == Reactions.last_page:
-            details[1] = details[2]
-
-        embed = self._get_updated_cue_embed()
-        await reaction.message.edit(embed=embed)
-
     @commands.group(name="cue", aliases=["c"], invoke_without_command=True)
     async def cue(
         self,
@@ -93,7 +55,7 @@ class Cue(CogInit):
     ) -> None:
         # 有指定成員
         if member is not None:
-            member_cue_list = self._get_member_cue_list(member)
+            member_cue_list = await self._get_member_cue_list(member)
 
             member_name = member.display_name
             # 有抓到語錄，發送語錄
@@ -107,15 +69,23 @@ class Cue(CogInit):
             else:
                 await ctx.send(f"{member_name} 沒有語錄")
             await ctx.message.delete()
+            return
 
-        # 獲取所有已記錄的語錄
-        cue_list = {doc["_id"]: doc["list"] for doc in self.mongo.find()}
-        # 隨機選定 ID、語錄串列
-        random_id, random_cue_list = random.choice(list(cue_list.items()))
+        # 由 Mongo 端展開所有語錄後隨機取樣一則，每則語錄被選中的機率相同
+        sampled = await self.mongo.aggregate(
+            [
+                {"$unwind": {"path": "$list", "includeArrayIndex": "pos"}},
+                {"$sample": {"size": 1}},
+            ]
+        )
+        if not sampled:
+            await ctx.send("目前沒有任何語錄")
+            await ctx.message.delete()
+            return
         # 獲取成員名稱、位置、語錄
-        member_name = self.bot.get_user(random_id).display_name
-        pos = random.randint(1, len(random_cue_list))
-        cue_string = random_cue_list[pos - 1]
+        member_name = self.bot.get_user(sampled[0]["_id"]).display_name
+        pos = sampled[0]["pos"] + 1
+        cue_string = sampled[0]["list"]
 
         await ctx.send(
             f"{member_name} 語錄 {pos} - {cue_string}",
@@ -125,13 +95,21 @@ class Cue(CogInit):
 
     @cue.command(aliases=["a"])
     async def add(self, ctx, member: discord.Member, *, cue_string) -> None:
-        # 獲取已添加過的語錄
-        member_cue_list = self._get_member_cue_list(member)
+        # 快取內已有此語錄時，不需存取 Mongo
+        member_cue_list = self._cue_cache.get(member.id)
+        if member_cue_list is None or cue_string not in member_cue_list:
+            # 以 $addToSet 新增並取回更新前的文件，一次往返即可得知是否添加過
+            before = await self.mongo.find_and_update(
+                {"_id": member.id}, {"$addToSet": {"list": cue_string}}
+            )
+            member_cue_list = before["list"] if before is not None else []
+            if cue_string in member_cue_list:
+                self._cue_cache[member.id] = member_cue_list
+            else:
+                self._cue_cache[member.id] = member_cue_list + [cue_string]
 
-        # 未在清單內: 未添加過，更新
+        # 未在清單內: 未添加過，已更新
         if cue_string not in member_cue_list:
-            self.mongo.update({"_id": member.id}, {"$push": {"list": cue_string}})
-
             member_name = member.display_name
             total_length = len(member_cue_list) + 1
 
@@ -151,7 +129,7 @@ class Cue(CogInit):
         self, ctx, member: discord.Member, pos_or_string: Union[int, str]
     ) -> None:
         # 獲取已添加的語錄
-        member_cue_list = self._get_member_cue_list(member)
+        member_cue_list = await self._get_member_cue_list(member)
 
         member_name = member.display_name
         # 沒有語錄無法刪除，傳送提示
@@ -191,7 +169,8 @@ class Cue(CogInit):
         # 語錄刪除後少於等於零個，連同成員紀錄刪除
         if len(member_cue_list) <= 1:
             # 刪除成員紀錄
-            self.mongo.delete({"_id": member.id})
+            await self.mongo.delete({"_id": member.id})
+            self._cue_cache.pop(member.id)
 
             await ctx.reply(
                 f"已刪除 {member_name} 語錄 {pos} - {cue_string}", delete_after=7
@@ -200,21 +179,16 @@ class Cue(CogInit):
             return
 
         # 以 $pull 操作符刪除指定語錄
-        self.mongo.update({"_id": member.id}, {"$pull": {"list": cue_string}})
+        await self.mongo.update({"_id": member.id}, {"$pull": {"list": cue_string}})
+        self._cue_cache[member.id] = [c for c in member_cue_list if c != cue_string]
         await ctx.reply(f"已刪除 {member_name} 語錄 {pos} - {cue_string}", delete_after=7)
         await ctx.message.delete(delay=7)
 
     @cue.command(aliases=["l"])
     async def list(self, ctx, member: discord.Member) -> None:
         await ctx.message.delete(delay=3)
-        # 嘗試刪除之前已送出的排行訊息
-        try:
-            if self.cue_msg_details and self.cue_msg_details[0] is not None:
-                await self.cue_msg_details[0].delete()
-        except discord.NotFound:
-            print("[Cue list] 找不到要刪除的訊息，已略過")
         member_name = member.display_name
-        member_cue_list = self._get_member_cue_list(member)
+        member_cue_list = await self._get_member_cue_list(member)
         # 無語錄紀錄，傳送提示
         if not member_cue_list:
             await ctx.reply(f"{member_name} 沒有語錄喔", delete_after=7)
@@ -222,20 +196,17 @@ class Cue(CogInit):
             return
 
         total_page = len(member_cue_list) // 21
-        # 初始化語錄訊息詳情
-        self.cue_msg_details = [None, total_page, total_page, member_cue_list, member]
-
-        # 取得要傳送的 Embed
-        embed = self._get_updated_cue_embed()
-        # 傳送 Embed 並記錄至詳情
-        cue_list_message = await ctx.send(embed=embed)
-        self.cue_msg_details[0] = cue_list_message
+        # 預先產生所有頁面，翻頁時不需重新產生
+        pages = [
+            self._get_cue_embed(member, member_cue_list, page, total_page)
+            for page in range(total_page + 1)
+        ]
+        # 預設顯示最後一頁
+        cue_list_message = await ctx.send(embed=pages[total_page])
+        self.bot.paginator.register(cue_list_message, pages, current=total_page)
 
         # 添加反應
-        await cue_list_message.add_reaction("<:first_page:806497548343705610>")
-        await cue_list_message.add_reaction("<:prev_page:805002492848767017>")
-        await cue_list_message.add_reaction("<:next_page:805002492525805589>")
-        await cue_list_message.add_reaction("<:last_page:806497548558532649>")
+        await self.bot.paginator.add_navigation(cue_list_message)
 
     @commands.command(aliases=["ca"])
     async def cue_add(self, ctx, member: discord.Member, *, cue_string) -> None:
@@ -1,28 +1,98 @@
-from typing import Union
+import asyncio
+import logging
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from typing import Any, Iterable, Union
 
 import discord
 from bot import ItkBot
-from bot.configs import Bot, Reactions
+from bot.configs import Bot, Cmds
 from bot.core import CogInit
 from bot.utils import MessageUtils
-from discord.ext import commands
+from discord.ext import commands, tasks
+from pymongo import ASCENDING, DESCENDING, DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError
+
+logger = logging.getLogger(__name__)
 
 
 class EmojiRank(CogInit):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        from bot.core import Mongo
-
-        self.mongo = Mongo("discord_669934356172636199", "emoji_rank")
-
-        self.rank_msg_details = []
+        self.mongo = self.bot.mongo.get("discord_669934356172636199", "emoji_rank")
+
+        # 記憶體內的排行，啟動時由 Mongo 載入，之後隨使用次數增量更新
+        self._rank_index = EmojiRankIndex()
+        # 改由 Mongo 依索引分頁查詢時，不在記憶體內保存排行
+        self._rank_from_mongo = Cmds.emoji_rank.rank_source == "mongo"
+        self._total_count = None
+
+        # 尚未寫回 Mongo 的表符使用次數
+        self._pending_counts = Counter()
+        self._flush_lock = asyncio.Lock()
+        self._flush_counts_task.start()
+
+        # 上次同步時群組表符的雜湊，相同則略過同步
+        self._emoji_set_hash = None
+        self.bot.loop.create_task(self._initial_reconcile())
+        if self._rank_from_mongo:
+            self.bot.loop.create_task(
+                self.mongo.create_index([("count", DESCENDING), ("_id", ASCENDING)])
+            )
 
-    def _db_add_emoji(self, emoji: Union[discord.abc.Snowflake, discord.Emoji]) -> None:
+    def cog_unload(self) -> None:
+        self._flush_counts_task.cancel()
+        self.bot.loop.create_task(self._flush_counts())
+
+    async def cog_close(self) -> None:
+        await self._flush_counts()
+
+    async def _flush_counts(self) -> None:
+        async with self._flush_lock:
+            if not self._pending_counts:
+                return
+
+            # 先換上新的暫存區，寫入期間的新增次數不會遺失
+            counts, self._pending_counts = self._pending_counts, Counter()
+            emos = list(counts)
+            requests = [
+                UpdateOne({"_id": emo}, {"$inc": {"count": counts[emo]}})
+                for emo in emos
+            ]
+            # $inc 不具冪等性，只在確定沒有寫入時放回暫存區重試，避免重複計數
+            try:
+                await self.mongo.bulk_write(requests, ordered=False)
+            except ServerSelectionTimeoutError:
+                # 找不到可用的伺服器，尚未送出任何寫入
+                self._pending_counts.update(counts)
+                logger.warning(f"Mongo unavailable, {len(requests)} emoji counts kept")
+            except BulkWriteError as e:
+                # 未排序的批次寫入中，只有回報錯誤的操作沒有套用
+                failed = {error["index"] for error in e.details["writeErrors"]}
+                self._pending_counts.update({emos[i]: counts[emos[i]] for i in failed})
+                logger.error(f"Failed to flush {len(failed)} emoji counts")
+            except asyncio.TimeoutError:
+                # 逾時只放棄等待，執行緒內的寫入多半仍會完成，因此不重試
+                logger.error(
+                    f"Timed out flushing {len(requests)} emoji counts, not retried"
+                )
+            except Exception:
+                # 無法確定是否已寫入，不重試
+                logger.exception(f"Failed to flush {len(requests)} emoji counts")
+
+    @tasks.loop(seconds=Cmds.emoji_rank.flush_interval)
+    async def _flush_counts_task(self) -> None:
+        await self._flush_counts()
+
+    async def _db_add_emoji(
+        self, emoji: Union[discord.abc.Snowflake, discord.Emoji]
+    ) -> None:
         # 若傳入的是 ID，先透過群組獲得 Emoji 物件
         if not isinstance(emoji, discord.Emoji):
             emoji = self.bot.get_emoji(emoji)
 
-        self.mongo.update(
+        await self.mongo.update(
             {"_id": emoji.id},
             {
                 "$set": {
@@ -33,24 +103,29 @@ class EmojiRank(CogInit):
                 }
             },
         )
+        self._total_count = None
+        if not self._rank_from_mongo:
+            self._rank_index.set(emoji.id, emoji.name, emoji.animated, 0)
 
-    def _db_delete_emoji(
+    async def _db_delete_emoji(
         self, emoji: Union[discord.abc.Snowflake, discord.Emoji]
     ) -> None:
         # 若傳進來的是 Emoji 物件，將變數設為其 ID
         if isinstance(emoji, discord.Emoji):
             emoji = emoji.id
 
-        self.mongo.delete({"_id": emoji})
+        await self.mongo.delete({"_id": emoji})
+        self._total_count = None
+        self._rank_index.remove(emoji)
 
-    def _db_update_emoji(
+    async def _db_update_emoji(
         self, emoji: Union[discord.abc.Snowflake, discord.Emoji]
     ) -> None:
         # 若傳進來的是 ID，先透過群組獲得 Emoji 物件
         if not isinstance(emoji, discord.Emoji):
             emoji = self.bot.get_emoji(emoji)
 
-        self.mongo.update(
+        await self.mongo.update(
             {"_id": emoji.id},
             {
                 "$set": {
@@ -59,19 +134,107 @@ class EmojiRank(CogInit):
             },
             upsert=False,
         )  # 不符合 query 不自動添加
-
-    async def _guild_emoji_list(self) -> set[discord.abc.Snowflake]:
-        guild = await self.bot.fetch_guild(Bot.main_guild)
-        return {emo.id for emo in guild.emojis}
+        self._rank_index.rename(emoji.id, emoji.name)
 
     async def _mongo_emoji_list(self) -> set[discord.abc.Snowflake]:
-        return {emo["_id"] for emo in self.mongo.find()}
+        return {emo["_id"] for emo in await self.mongo.find()}
+
+    async def _initial_reconcile(self) -> None:
+        # 重新載入 cog 時不會觸發 on_ready，因此建立時自行同步一次
+        await self.bot.wait_until_ready()
+        await self._reconcile_emojis()
+
+    async def _reconcile_emojis(self) -> None:
+        guild = self.bot.get_guild(Bot.main_guild)
+        if guild is None:
+            return
+
+        guild_emojis = {emo.id: emo for emo in guild.emojis}
+        emoji_set_hash = hash(
+            frozenset((emo.id, emo.name, emo.animated) for emo in guild.emojis)
+        )
+        # 與寫回共用鎖，確保載入的次數加上暫存區剛好是實際次數
+        async with self._flush_lock:
+            if emoji_set_hash == self._emoji_set_hash:
+                return
+
+            start_time = time.perf_counter()
+            mongo_emojis = {doc["_id"]: doc for doc in await self.mongo.find()}
+
+            requests = []
+            deleted = added = renamed = 0
+            # Mongo 殘存群組已刪除的表符
+            for emo_id in mongo_emojis.keys() - guild_emojis.keys():
+                requests.append(DeleteOne({"_id": emo_id}))
+                del mongo_emojis[emo_id]
+                deleted += 1
+            for emo_id, emo in guild_emojis.items():
+                doc = mongo_emojis.get(emo_id)
+                # 群組內未上傳至 Mongo 的表符
+                if doc is None:
+                    doc = {
+                        "_id": emo.id,
+                        "name": emo.name,
+                        "animated": emo.animated,
+                        "count": 0,
+                    }
+                    requests.append(
+                        UpdateOne({"_id": emo.id}, {"$set": doc}, upsert=True)
+                    )
+                    mongo_emojis[emo_id] = doc
+                    added += 1
+                # 僅補正確實已改名的表符
+                elif doc["name"] != emo.name or doc["animated"] != emo.animated:
+                    changes = {"name": emo.name, "animated": emo.animated}
+                    requests.append(UpdateOne({"_id": emo.id}, {"$set": changes}))
+                    doc.update(changes)
+                    renamed += 1
+
+            await self.mongo.bulk_write(requests, ordered=False)
+
+            self._total_count = len(mongo_emojis)
+            if not self._rank_from_mongo:
+                self._rank_index.load(mongo_emojis.values())
+                for emo, count in self._pending_counts.items():
+                    self._rank_index.increment(emo, count)
+            self._emoji_set_hash = emoji_set_hash
+
+        logger.info(
+            f"Emoji reconciled | +{added} ~{renamed} -{deleted} "
+            f"in {time.perf_counter() - start_time:.3f}s"
+        )
 
-    async def _get_updated_rank_embed(self) -> discord.Embed:
-        current_page = self.rank_msg_details[1]
-        total_page = self.rank_msg_details[2]
-        rank_data = self.rank_msg_details[3]
+    async def _get_emoji_total(self) -> int:
+        if not self._rank_from_mongo:
+            return len(self._rank_index)
+        if self._total_count is None:
+            self._total_count = await self.mongo.count()
+        return self._total_count
+
+    async def _get_rank_page(self, start: int, end: int) -> list[dict[str, Any]]:
+        if not self._rank_from_mongo:
+            return self._rank_index.page(start, end)
+
+        # 先寫回暫存的使用次數，避免排行少算
+        await self._flush_counts()
+        docs = await self.mongo.find_page(
+            sort=[("count", DESCENDING), ("_id", ASCENDING)],
+            skip=start,
+            limit=end - start,
+        )
+        return [
+            {
+                "id": doc["_id"],
+                "name": doc["name"],
+                "animated": doc["animated"],
+                "count": doc["count"],
+            }
+            for doc in docs
+        ]
 
+    async def _get_rank_embed(
+        self, current_page: int, total_page: int
+    ) -> discord.Embed:
         embed = discord.Embed()
         # Author
         embed.set_author(
@@ -80,11 +243,11 @@ class EmojiRank(CogInit):
         # Footer
         embed.set_footer(text=f"頁 {current_page + 1} / {total_page + 1}")
         # Thumbnail
-        embed.set_thumbnail(url=(await self.bot.fetch_guild(Bot.main_guild)).icon_url)
+        embed.set_thumbnail(url=self.bot.get_guild(Bot.main_guild).icon_url)
         # Fields
         start = current_page * 12
         end = start + 12
-        for rank, emoji in enumerate(rank_data[start:end], start + 1):
+        for rank, emoji in enumerate(await self._get_rank_page(start, end), start + 1):
             animated = "a" if emoji["animated"] else ""
             name = emoji["name"]
             emoji_id = emoji["id"]
@@ -98,21 +261,8 @@ class EmojiRank(CogInit):
 
     @commands.Cog.listener()
     async def on_ready(self) -> None:
-        # 獲取群內的表符 ID
-        guild_emojis = await self._guild_emoji_list()
-        # 獲取 Mongo 內的表符 ID
-        mongo_emojis = await self._mongo_emoji_list()
-
-        # 檢查 Mongo 是否殘存群組已刪除的表符，若有則刪除
-        for emo in mongo_emojis:
-            if emo not in guild_emojis:
-                self._db_delete_emoji(emo)
-        # 檢查群組是否有未上傳至 Mongo 的表符，若有則新增
-        for emo in guild_emojis:
-            if emo not in mongo_emojis:
-                self._db_add_emoji(emo)
-                continue
-            self._db_update_emoji(emo)  # 補正已改名的表符
+        # 重新連線時，群組表符沒有變動則不會寫入
+        await self._reconcile_emojis()
 
     @commands.Cog.listener()
     async def on_guild_emojis_update(
@@ -128,11 +278,17 @@ class EmojiRank(CogInit):
         # 變更前數量 > 變更後數量: 刪除表符
         if len(before) > len(after):
             for emo in [_ for _ in before if _ not in after]:
-                self._db_delete_emoji(emo)
+                await self._db_delete_emoji(emo)
         # 變更前數量 < 變更後數量: 增加表符
         elif len(before) < len(after):
             for emo in [_ for _ in after if _ not in before]:
-                self._db_add_emoji(emo)
+                await self._db_add_emoji(emo)
+        # 數量相同: 表符改名
+        else:
+            before_names = {emo.id: emo.name for emo in before}
+            for emo in after:
+                if before_names.get(emo.id, emo.name) != emo.name:
+                    await self._db_update_emoji(emo)
 
     @commands.Cog.listener()
     async def on_message(self, msg: discord.Message) -> None:
@@ -144,52 +300,16 @@ class EmojiRank(CogInit):
 
         # 正則找出訊息內使用的所有表符，重複只算一次
         emojis_in_msg = set(re.findall(r"<a?:.*?:(\d*)>", msg.content))
+        # 先累計於記憶體，定時或達到門檻時再一次寫回
+        emojis_in_msg = [int(emo) for emo in emojis_in_msg if emo]
+        self._pending_counts.update(emojis_in_msg)
         for emo in emojis_in_msg:
-            self.mongo.update(
-                {"_id": int(emo)}, {"$inc": {"count": 1}}, upsert=False
-            )  # 不符合 query 不自動添加
-
-    @commands.Cog.listener()
-    async def on_message_delete(self, msg: discord.Message) -> None:
-        if not self.rank_msg_details or self.rank_msg_details[0] is None:
-            return
-
-        if msg == self.rank_msg_details[0]:
-            self.rank_msg_details = []
-
-    @commands.Cog.listener()
-    async def on_reaction_add(
-        self, reaction: discord.Reaction, user: discord.User
-    ) -> None:
-        # 忽略來自機器人的 Emoji 添加事件
-        if user.bot:
-            return
-        # 如果之前沒有列出排行，或事件訊息不是排行訊息，忽略
-        if not self.rank_msg_details or reaction.message != self.rank_msg_details[0]:
-            return
-        await reaction.remove(user)
-
-        details = self.rank_msg_details
-
-        # 上一頁
-        if str(reaction.emoji) == Reactions.prev_page:
-            # 避免頁數出現負值
-            if details[1] != 0:
-                details[1] -= 1
-        # 下一頁
-        elif str(reaction.emoji) == Reactions.next_page:
-            # 避免頁數超出總頁數
-            if details[1] != details[2]:
-                details[1] += 1
-        # 首頁
-        elif str(reaction.emoji) == Reactions.first_page:
-            details[1] = 0
-        # 末頁
-        elif str(reaction.emoji) == Reactions.last_page:
-            details[1] = details[2]
-
-        embed = await self._get_updated_rank_embed()
-        await reaction.message.edit(embed=embed)
+            self._rank_index.increment(emo, 1)
+        if (
+            sum(self._pending_counts.values()) >= Cmds.emoji_rank.flush_threshold
+            and not self._flush_lock.locked()
+        ):
+            self.bot.loop.create_task(self._flush_counts())
 
     @commands.group(name="emoji", aliases=["emo", "e"], invoke_without_command=True)
     async def emoji(self, ctx: commands.Context) -> None:
@@ -198,39 +318,20 @@ class EmojiRank(CogInit):
     @emoji.command(aliases=["r"])
     async def rank(self, ctx: commands.Context) -> None:
         await ctx.message.delete(delay=3)
-        # 嘗試刪除之前已送出的排行訊息
-        try:
-            if self.rank_msg_details and self.rank_msg_details[0] is not None:
-                await self.rank_msg_details[0].delete()
-        except discord.NotFound:
-            print("[Emoji rank] 找不到要刪除的訊息，已略過")
-        # 獲取 Mongo 內的統計資料並排序
-        db_emo_list = [
-            {
-                "id": emo["_id"],
-                "name": emo["name"],
-                "animated": emo["animated"],
-                "count": emo["count"],
-            }
-            for emo in self.mongo.find()
-        ]
-        ranked_emo_list = sorted(db_emo_list, key=lambda x: x["count"], reverse=True)
-        total_page = len(ranked_emo_list) // 12
-
-        # 初始化排行訊息詳情
-        self.rank_msg_details = [None, 0, total_page, ranked_emo_list]
+        total_page = await self._get_emoji_total() // 12
 
-        # 取得要傳送的 Embed
-        embed = await self._get_updated_rank_embed()
-        # 傳送 Embed 並記錄至詳情
+        # 傳送第一頁，其餘頁面在翻到時才產生並保留
+        embed = await self._get_rank_embed(0, total_page)
         rank_message = await ctx.send(embed=embed)
-        self.rank_msg_details[0] = rank_message
+        self.bot.paginator.register(
+            rank_message,
+            [embed],
+            total=total_page + 1,
+            factory=lambda page: self._get_rank_embed(page, total_page),
+        )
 
         # 添加反應
-        await rank_message.add_reaction("<:first_page:806497548343705610>")
-        await rank_message.add_reaction("<:prev_page:805002492848767017>")
-        await rank_message.add_reaction("<:next_page:805002492525805589>")
-        await rank_message.add_reaction("<:last_page:806497548558532649>")
+        await self.bot.paginator.add_navigation(rank_message)
 
     @emoji.command()
     async def reset(self, ctx: commands.Context) -> None:
@@ -238,19 +339,24 @@ class EmojiRank(CogInit):
         if not (await self.bot.is_owner(ctx.author)):
             return
 
+        # 捨棄尚未寫回的次數，避免重置後又被加回
+        self._pending_counts.clear()
         # 次數設為零，同時補正已更名的表符
         for emo in await self._mongo_emoji_list():
-            self.mongo.update(
+            name = self.bot.get_emoji(emo).name
+            await self.mongo.update(
                 {
                     "_id": emo,
                 },
                 {
                     "$set": {
-                        "name": self.bot.get_emoji(emo).name,
+                        "name": name,
                         "count": 0,
                     }
                 },
             )
+            self._rank_index.rename(emo, name)
+            self._rank_index.set_count(emo, 0)
         await MessageUtils.reply_then_delete(ctx, "記錄重置成功", 5)
 
     @commands.command(aliases=["er"])
@@ -259,5 +365,67 @@ class EmojiRank(CogInit):
         await ctx.invoke(self.bot.get_command("emoji rank"))
 
 
+class EmojiRankIndex:
+    """依使用次數排序的表符索引，讀取任一頁只需切片"""
+
+    def __init__(self) -> None:
+        self._emojis: dict[int, dict[str, Any]] = {}
+        # 以 (-次數, ID) 排序，次數高者在前
+        self._order: list[tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._emojis)
+
+    def load(self, docs: Iterable[dict[str, Any]]) -> None:
+        self._emojis = {
+            doc["_id"]: {
+                "id": doc["_id"],
+                "name": doc["name"],
+                "animated": doc["animated"],
+                "count": doc["count"],
+            }
+            for doc in docs
+        }
+        self._order = sorted(
+            (-emo["count"], emo["id"]) for emo in self._emojis.values()
+        )
+
+    def set(self, emoji_id: int, name: str, animated: bool, count: int) -> None:
+        self.remove(emoji_id)
+        self._emojis[emoji_id] = {
+            "id": emoji_id,
+            "name": name,
+            "animated": animated,
+            "count": count,
+        }
+        insort(self._order, (-count, emoji_id))
+
+    def remove(self, emoji_id: int) -> None:
+        emoji = self._emojis.pop(emoji_id, None)
+        if emoji is None:
+            return
+        del self._order[bisect_left(self._order, (-emoji["count"], emoji_id))]
+
+    def rename(self, emoji_id: int, name: str) -> None:
+        if emoji_id in self._emojis:
+            self._emojis[emoji_id]["name"] = name
+
+    def set_count(self, emoji_id: int, count: int) -> None:
+        emoji = self._emojis.get(emoji_id)
+        # 不在索引內的表符不自動添加，與 Mongo 的 upsert=False 一致
+        if emoji is None:
+            return
+        del self._order[bisect_left(self._order, (-emoji["count"], emoji_id))]
+        emoji["count"] = count
+        insort(self._order, (-count, emoji_id))
+
+    def increment(self, emoji_id: int, amount: int) -> None:
+        if emoji_id in self._emojis:
+            self.set_count(emoji_id, self._emojis[emoji_id]["count"] + amount)
+
+    def page(self, start: int, end: int) -> list[dict[str, Any]]:
+        return [self._emojis[emoji_id] for _, emoji_id in self._order[start:end]]
+
+
 def setup(bot: ItkBot) -> None:
     bot.add_cog(EmojiRank(bot))
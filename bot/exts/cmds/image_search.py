@@ -1,28 +1,66 @@
+import asyncio
 import re
-from typing import Any
+import time
+from datetime import datetime, timedelta
+from typing import Any, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
+import aiohttp
 import discord
 from bot import ItkBot
-from bot.configs import Bot, Colors, Emojis, Reactions
-from bot.core import CogInit
+from bot.configs import Bot, Cmds, Colors, Emojis, Reactions
+from bot.core import CogInit, SlidingWindowLimiter, SQLiteCache, dhash
 from bot.utils import MessageUtils
 from discord.ext import commands
-from saucenao_api import SauceNao, errors
+from PIL import UnidentifiedImageError
+from saucenao_api import AIOSauceNao, errors
+from saucenao_api.containers import SauceResponse
+
+# 附件網址帶有時效簽章參數，比對時只保留路徑
+_DISCORD_CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+
+
+def _normalize_url(url: str) -> str:
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host in _DISCORD_CDN_HOSTS:
+        host, query = _DISCORD_CDN_HOSTS[0], ""
+    else:
+        query = urlencode(sorted(parse_qsl(parts.query)))
+    return urlunsplit((parts.scheme.lower(), host, parts.path, query, ""))
 
 
 class ImgSearch(CogInit):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self.sn = SauceNao(Bot.sauce_nao_key, dbmask=1666715746400, numres=3)
+        self.sn = AIOSauceNao(Bot.sauce_nao_key, dbmask=1666715746400, numres=3)
+        self._sn_opened = False
+        # 同時進行的搜尋數量，以及 SauceNao 短時間內的請求次數限制
+        self._search_semaphore = asyncio.Semaphore(Cmds.image_search.concurrency)
+        self._rate_limiter = SlidingWindowLimiter(
+            Cmds.image_search.short_limit, Cmds.image_search.short_window
+        )
+        # 以網址及圖片指紋保存搜尋結果，重複搜尋不消耗次數
+        self._result_cache = SQLiteCache(
+            Cmds.image_search.cache_path, Cmds.image_search.cache_ttl
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
         self.IMG_LINK_PATTERN = re.compile(
             r"(https?:\/\/[^\s]*(\?format=\w*&name=\d*x\d*|(\.png|\.jpg|\.jpeg)))"
         )
 
-        self.result_list = {}
+        # 反應表符 -> 結果序號
         self.reaction_emos = {
             r: i for i, r in enumerate(Reactions.numbers + Reactions.letters)
         }
 
+    def cog_unload(self) -> None:
+        if self._sn_opened:
+            self.bot.loop.create_task(self.sn.__aexit__(None, None, None))
+        if self._session is not None:
+            self.bot.loop.create_task(self._session.close())
+        self._result_cache.close()
+
     @staticmethod
     def _isfloat(param: Any) -> bool:
         try:
@@ -31,13 +69,25 @@ class ImgSearch(CogInit):
         except ValueError:
             return False
 
+    @staticmethod
+    def _quota_text(remain: int, cached_at: Optional[float]) -> str:
+        if cached_at is None:
+            return f"24h 內剩餘可用次數: {remain}"
+        cached_time = datetime.utcfromtimestamp(cached_at) + timedelta(hours=8)
+        return f"快取結果 ({cached_time:%Y/%m/%d %H:%M})"
+
     def _get_result_embed(
-        self, i: int, res: dict[str, Any], remain: int
+        self,
+        i: int,
+        res: dict[str, Any],
+        remain: int,
+        cached_at: Optional[float] = None,
     ) -> discord.Embed:
         embed = discord.Embed(title="搜尋結果", color=Colors.blue)
         # Footer
         embed.set_footer(
-            text=f"第 {i} 張圖｜24h 內剩餘可用次數: {remain}", icon_url=self.bot.user.avatar_url
+            text=f"第 {i} 張圖｜{self._quota_text(remain, cached_at)}",
+            icon_url=self.bot.user.avatar_url,
         )
         # Thumbnail
         if res.thumbnail:
@@ -61,11 +111,14 @@ class ImgSearch(CogInit):
             embed.add_field(name="來源", value=res.raw["data"]["source"], inline=False)
         return embed
 
-    def _get_no_result_embed(self, i: int, img_url: str, remain: int) -> discord.Embed:
+    def _get_no_result_embed(
+        self, i: int, img_url: str, remain: int, cached_at: Optional[float] = None
+    ) -> discord.Embed:
         embed = discord.Embed(title="搜尋結果", color=Colors.red)
         # Footer
         embed.set_footer(
-            text=f"第 {i} 張圖｜24h 內可使用次數: {remain}", icon_url=self.bot.user.avatar_url
+            text=f"第 {i} 張圖｜{self._quota_text(remain, cached_at)}",
+            icon_url=self.bot.user.avatar_url,
         )
         # Thumbnail
         embed.set_thumbnail(url=img_url)
@@ -74,41 +127,161 @@ class ImgSearch(CogInit):
 
         return embed
 
-    @commands.Cog.listener()
-    async def on_reaction_add(
-        self, reaction: discord.Reaction, user: discord.User
-    ) -> None:
-        # 忽略機器人的反應添加事件
-        if user.bot:
-            return
-        # 如果沒有結果訊息紀錄，或不是結果訊息，略過
-        if not self.result_list or reaction.message.id not in self.result_list:
-            return
+    def _get_error_embed(self, i: int, img_url: str, reason: str) -> discord.Embed:
+        embed = discord.Embed(title="搜尋結果", color=Colors.red)
+        # Footer
+        embed.set_footer(text=f"第 {i} 張圖", icon_url=self.bot.user.avatar_url)
+        # Thumbnail
+        embed.set_thumbnail(url=img_url)
+        # Fields
+        embed.add_field(name="搜尋失敗", value=reason)
 
-        await reaction.remove(user)
-        raw_reaction = str(reaction.emoji)
-        # 如果不是指定的反應表符，略過
-        if raw_reaction not in self.reaction_emos:
-            return
+        return embed
 
-        # 反應所代表的數字小於結果串列長度
-        if self.reaction_emos[raw_reaction] < len(
-            self.result_list[reaction.message.id]
-        ):
-            await reaction.message.edit(
-                content=reaction.message.content,
-                embed=self.result_list[reaction.message.id][
-                    self.reaction_emos[raw_reaction]
-                ],
+    async def _search(
+        self, i: int, img_url: str, min_similarity: float, msg: discord.Message
+    ) -> List[discord.Embed]:
+        """搜尋單張圖片，回傳結果 Embed；除了每日次數用盡外，錯誤皆轉為錯誤 Embed"""
+        # 共用同一個連線 session，避免每次搜尋都重新建立連線
+        if not self._sn_opened:
+            await self.sn.__aenter__()
+            self._sn_opened = True
+
+        try:
+            async with self._search_semaphore:
+                results, cached_at = await self._cached_search(img_url, msg)
+        except errors.ShortLimitReachedError:
+            self._rate_limiter.exhaust()
+            return [self._get_error_embed(i, img_url, "短時間內搜尋太多次，請稍後再試")]
+        except errors.LongLimitReachedError:
+            raise
+        except asyncio.TimeoutError:
+            return [self._get_error_embed(i, img_url, "搜尋逾時")]
+        except errors.UnknownServerError:
+            return [
+                self._get_error_embed(
+                    i, img_url, f"搜圖伺服器爆掉了，窩無能為力 {Emojis.pepe_depressed}"
+                )
+            ]
+        except errors.BadFileSizeError:
+            return [self._get_error_embed(i, img_url, "圖片太大了，搜不了")]
+        except (errors.SauceNaoApiError, aiohttp.ClientError):
+            # 包含金鑰無效 (BadKeyError) 及其他未知的 API 錯誤
+            return [
+                self._get_error_embed(i, img_url, f"嗚呼，搜圖 API 爆掉了 {Emojis.pepe_hypers}")
+            ]
+
+        # 相似度小於指定相似度的結果略過
+        embeds = [
+            self._get_result_embed(i, res, results.long_remaining, cached_at)
+            for res in results
+            if res.similarity >= min_similarity
+        ]
+        # 完全沒有高於指定相似度的結果
+        return embeds or [
+            self._get_no_result_embed(i, img_url, results.long_remaining, cached_at)
+        ]
+
+    async def _fingerprint(self, img_url: str) -> Optional[int]:
+        """下載圖片並計算 dHash，失敗時回傳 None"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=Cmds.image_search.timeout)
             )
 
-    @commands.Cog.listener()
-    async def on_message_delete(self, msg: discord.Message) -> None:
-        if not self.result_list:
-            return
+        max_bytes = Cmds.image_search.max_download_bytes
+        try:
+            async with self._session.get(img_url) as resp:
+                resp.raise_for_status()
+                if (resp.content_length or 0) > max_bytes:
+                    return None
+                data = await resp.content.read(max_bytes + 1)
+            if len(data) > max_bytes:
+                return None
+            # 解碼圖片較耗時，交給執行緒處理
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, dhash, data)
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            UnidentifiedImageError,
+            OSError,
+        ):
+            return None
+
+    async def _nearest_cached(self, fingerprint: int) -> Optional[Tuple[Any, float]]:
+        """在相似圖片索引中，由近到遠找出第一張已有快取結果的圖片"""
+        matches = await self.bot.phashes.search(
+            fingerprint, Bot.phash_index.max_distance, limit=50
+        )
+        checked = set()
+        for match in matches:
+            # 索引內以有號整數保存
+            value = match["hash"] & 0xFFFFFFFFFFFFFFFF
+            if value in checked:
+                continue
+            checked.add(value)
+            cached = await self._result_cache.get(f"dhash:{value:016x}")
+            if cached is not None:
+                return cached
+        return None
 
-        if msg.id in self.result_list:
-            del self.result_list[msg.id]
+    async def _cached_search(
+        self, img_url: str, msg: discord.Message
+    ) -> tuple[SauceResponse, Optional[float]]:
+        """先以網址及圖片指紋查詢快取，都沒有時才向 SauceNao 搜尋
+
+        回傳 (搜尋結果, 快取寫入時間)，非快取結果的寫入時間為 None
+        """
+        keys = [f"url:{_normalize_url(img_url)}"]
+        cached = await self._result_cache.get(keys[0])
+        if cached is None:
+            fingerprint = await self._fingerprint(img_url)
+            if fingerprint is not None:
+                keys.append(f"dhash:{fingerprint:016x}")
+                cached = await self._result_cache.get(keys[1])
+                if cached is None:
+                    cached = await self._nearest_cached(fingerprint)
+                # 相同或相近圖片的新網址，之後可直接以網址及指紋命中
+                if cached is not None:
+                    await self._result_cache.set(keys, *cached)
+                # 記錄至相似圖片索引
+                await self.bot.phashes.add(
+                    fingerprint,
+                    "search",
+                    img_url,
+                    guild_id=msg.guild.id if msg.guild else None,
+                    channel_id=msg.channel.id,
+                    message_id=msg.id,
+                    author_id=msg.author.id,
+                )
+        if cached is not None:
+            return SauceResponse(cached[0]), cached[1]
+
+        await self._rate_limiter.acquire()
+        results = await asyncio.wait_for(
+            self.sn.from_url(img_url), timeout=Cmds.image_search.timeout
+        )
+        await self._result_cache.set(keys, results.raw)
+        return results, None
+
+    async def _collect_image_urls(
+        self, ctx: commands.Context, args: Tuple[str, ...]
+    ) -> List[str]:
+        queue = []
+        # 若有回覆訊息，先抓取回覆訊息內附件、圖片連結
+        if ctx.message.reference:
+            ref_msg = await ctx.channel.fetch_message(ctx.message.reference.message_id)
+            queue += [a.url for a in ref_msg.attachments] + [
+                a[0] for a in re.findall(self.IMG_LINK_PATTERN, ref_msg.content)
+            ]
+        # 若有上傳附件，獲取訊息內圖片連結
+        if ctx.message.attachments:
+            queue += [a.url for a in ctx.message.attachments]
+        # 若有附上圖片連結，抓取訊息內圖片連結
+        if args:
+            queue += [a for a in args if re.match(self.IMG_LINK_PATTERN, a)]
+        return queue
 
     @commands.command(aliases=["is"])
     async def image_search(self, ctx: commands.Context, *args) -> None:
@@ -117,69 +290,61 @@ class ImgSearch(CogInit):
             last_isfloat = self._isfloat(args[-1]) if args else False
             min_similarity = float(args[-1]) if (args and last_isfloat) else 72
 
-            queue = []
-            # 若有回覆訊息，先抓取回覆訊息內附件、圖片連結
-            if ctx.message.reference:
-                ref_msg = await ctx.channel.fetch_message(
-                    ctx.message.reference.message_id
-                )
-                queue += [a.url for a in ref_msg.attachments] + [
-                    a[0] for a in re.findall(self.IMG_LINK_PATTERN, ref_msg.content)
-                ]
-            # 若有上傳附件，獲取訊息內圖片連結
-            if ctx.message.attachments:
-                queue += [a.url for a in ctx.message.attachments]
-            # 若有附上圖片連結，抓取訊息內圖片連結
-            if args[:-1] if last_isfloat else args:
-                queue += [
-                    a
-                    for a in (args[:-1] if last_isfloat else args)
-                    if re.match(self.IMG_LINK_PATTERN, a)
-                ]
+            queue = await self._collect_image_urls(
+                ctx, args[:-1] if last_isfloat else args
+            )
             # 執行至此佇列仍為空，判定為未給予搜尋要素
             if not queue:
                 raise NoImageToQuery
 
-            result_embeds = []
             # 最多僅搜尋佇列前 6
-            for i, img_url in enumerate(queue[:6], 1):
-                at_least_one_result = False
-
-                results = self.sn.from_url(url=img_url)
-                for res in results:
-                    # 相似度小於指定相似度，略過
-                    if res.similarity < min_similarity:
-                        continue
-
-                    at_least_one_result = True
-                    # 獲取結果 Embed
-                    result_embeds.append(
-                        self._get_result_embed(i, res, results.long_remaining)
-                    )
-                # 完全沒有高於指定相似度的結果
-                if not at_least_one_result:
-                    # 獲取無結果 Embed
-                    result_embeds.append(
-                        self._get_no_result_embed(i, img_url, results.long_remaining)
-                    )
-            # 送出搜尋結果訊息
+            queue = queue[:6]
+            # 先送出搜尋結果訊息，結果陸續完成時再更新
             result_msg = await MessageUtils.reply_then_delete(
-                ctx, "", 240, embed=result_embeds[0]
+                ctx, f"搜尋中... 0/{len(queue)}", 240
             )
-            # 添加搜尋結果訊息
-            self.result_list[result_msg.id] = result_embeds
-            # 添加反應
-            for i in range(len(result_embeds)):
-                await result_msg.add_reaction(list(self.reaction_emos.keys())[i])
+            # 登記為分頁訊息，以數字反應切換結果
+            result_embeds = self.bot.paginator.register(
+                result_msg, jump=self.reaction_emos
+            ).pages
+
+            searches = [
+                asyncio.create_task(
+                    self._search(i, img_url, min_similarity, ctx.message)
+                )
+                for i, img_url in enumerate(queue, 1)
+            ]
+            try:
+                for done, search in enumerate(asyncio.as_completed(searches), 1):
+                    embeds = await search
+                    result_embeds.extend(embeds)
+                    progress = {
+                        "content": (
+                            f"搜尋中... {done}/{len(queue)}" if done < len(queue) else None
+                        )
+                    }
+                    # 只在第一筆結果送達時設定 Embed，避免覆蓋使用者切換的結果
+                    if len(result_embeds) == len(embeds):
+                        progress["embed"] = result_embeds[0]
+                    await result_msg.edit(**progress)
+                    # 添加反應
+                    for i in range(
+                        len(result_embeds) - len(embeds), len(result_embeds)
+                    ):
+                        await result_msg.add_reaction(
+                            list(self.reaction_emos.keys())[i]
+                        )
+            except Exception:
+                # 任何錯誤都停止其餘搜尋，並清除停在「搜尋中」的訊息
+                for search in searches:
+                    search.cancel()
+                if not result_embeds:
+                    self.bot.paginator.discard(result_msg.id)
+                    await result_msg.delete()
+                else:
+                    await result_msg.edit(content=None)
+                raise
 
-        except errors.UnknownApiError:
-            await MessageUtils.reply_then_delete(
-                ctx, f"嗚呼，搜圖 API 爆掉了 {Emojis.pepe_hypers}"
-            )
-        except errors.UnknownServerError:
-            await MessageUtils.reply_then_delete(
-                ctx, f"搜圖伺服器爆掉了，窩無能為力 {Emojis.pepe_depressed}"
-            )
         except errors.LongLimitReachedError:
             await MessageUtils.reply_then_delete(
                 ctx, f"今天的搜尋次數已達上限 {Emojis.pepe_hands}"
@@ -187,6 +352,56 @@ class ImgSearch(CogInit):
         except NoImageToQuery:
             await MessageUtils.reply_then_delete(ctx, f"你是不是沒有放上要找的圖 {Emojis.thonk}")
 
+    @commands.command(aliases=["ih"])
+    async def image_history(self, ctx: commands.Context, *args) -> None:
+        """找出伺服器內曾經出現或被搜尋過的相同 (或相近) 圖片"""
+        if not (await self.bot.is_owner(ctx.author)):
+            return
+
+        queue = await self._collect_image_urls(ctx, args)
+        if not queue:
+            await MessageUtils.reply_then_delete(ctx, f"你是不是沒有放上要找的圖 {Emojis.thonk}")
+            return
+
+        fingerprint = await self._fingerprint(queue[0])
+        if fingerprint is None:
+            await MessageUtils.reply_then_delete(ctx, "無法讀取這張圖片")
+            return
+
+        start_time = time.perf_counter()
+        matches = await self.bot.phashes.search(
+            fingerprint, Bot.phash_index.max_distance
+        )
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+
+        lines = []
+        for match in matches:
+            seen_time = datetime.utcfromtimestamp(match["created_at"]) + timedelta(
+                hours=8
+            )
+            where = "搜尋" if match["source"] == "search" else "備份"
+            if match["guild_id"] and match["message_id"]:
+                where = (
+                    f"[{where}](https://discord.com/channels/{match['guild_id']}"
+                    f"/{match['channel_id']}/{match['message_id']})"
+                )
+            author = f"<@{match['author_id']}>" if match["author_id"] else ""
+            lines.append(
+                f"`{seen_time:%Y/%m/%d %H:%M}` 距離 {match['distance']}｜{where} {author}"
+            )
+
+        embed = discord.Embed(
+            title=f"相似圖片｜{len(matches)} 筆",
+            description="\n".join(lines) or "沒有出現過這張圖片",
+            color=Colors.blue,
+        )
+        embed.set_thumbnail(url=queue[0])
+        embed.set_footer(
+            text=f"共 {len(self.bot.phashes)} 張圖片｜{elapsed_ms:.1f}ms",
+            icon_url=self.bot.user.avatar_url,
+        )
+        await MessageUtils.reply_then_delete(ctx, "", 120, embed=embed)
+
 
 class NoImageToQuery(Exception):
     pass
@@ -1,16 +1,25 @@
+import asyncio
 import logging
 import random
 import re
-from datetime import timedelta
-from itertools import cycle
-from pathlib import Path
-from typing import Optional
+import time
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 import discord
+import httplib2
 from bot import ItkBot
 from bot.configs import Bot, Emojis, Events
-from bot.core import CogInit
-from discord.ext import commands
+from bot.core import (
+    ApiKeyPool,
+    CogInit,
+    MessageRecord,
+    MessageStore,
+    TriggerEngine,
+    TTLCache,
+)
+from discord.ext import commands, tasks
 from googleapiclient import discovery, errors
 
 logger = logging.getLogger(__name__)
@@ -19,12 +28,33 @@ logger = logging.getLogger(__name__)
 class EventHandlers(CogInit):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self.backup_path = Path(Bot.image_folder, "backup")
-        self.backup_path.mkdir(exist_ok=True)
-
         self.muted = {"status": False, "start_time": None}
+        self.messages = MessageStore(Bot.message_store_bytes)
+
+        self.google_search_keys = ApiKeyPool(
+            Bot.google_search_api_keys, Bot.google_search_key_pool.daily_quota
+        )
+        # 每個金鑰只建立一次 service 物件
+        self._google_services: Dict[str, Any] = {}
+        self._google_search_cache = TTLCache(
+            Bot.google_search_cache.maxsize, Bot.google_search_cache.ttl
+        )
+
+        self.triggers = TriggerEngine(Events.triggers)
+        for trigger in self.triggers.rules:
+            if not (trigger.images or trigger.reply or self._trigger_handler(trigger)):
+                logger.error(f"Trigger {trigger.name} has nothing to respond with")
 
-        self.google_search_api_keys = cycle(Bot.google_search_api_keys)
+        self._sweep_backups_task.start()
+
+    def cog_unload(self) -> None:
+        self._sweep_backups_task.cancel()
+
+    @tasks.loop(seconds=Bot.backup.sweep_interval)
+    async def _sweep_backups_task(self) -> None:
+        await self.bot.backups.sweep(
+            Bot.backup.max_age_days * 86400, Bot.backup.max_bytes
+        )
 
     def _is_command(self, text: str) -> bool:
         return text.lower()[1:].split(" ")[0] in self.bot.ignore_kw_list
@@ -34,32 +64,258 @@ class EventHandlers(CogInit):
             text.lower() == image_ext for image_ext in ("jpg", "jpeg", "png", "gif")
         )
 
+    def _backup_files(self, message_id: int) -> List[discord.File]:
+        # 以訊息 ID 查詢已備份的圖片檔，並還原為原本的序號檔名
+        return [
+            discord.File(
+                self.bot.backups.path(file),
+                filename=f"{message_id}_{file.idx:02d}.{file.ext}",
+            )
+            for file in self.bot.backups.files(message_id)
+        ]
+
     def _is_in_mentions(self, msg: discord.Message) -> bool:
         return self.bot.user in msg.mentions and not self._is_command(
             msg.content.lower()
         )
 
-    def google_search(self, q: str, **kwargs) -> Optional[dict]:
-        key = next(self.google_search_api_keys)
+    def _execute_google_search(self, key: str, timeout: float, **params) -> dict:
+        """於執行緒內執行搜尋，每把金鑰的服務物件只建立一次"""
+        service = self._google_services.get(key)
+        if service is None:
+            # 使用套件內附的 discovery 文件，建立時不需連線
+            service = self._google_services[key] = discovery.build(
+                "customsearch",
+                "v1",
+                developerKey=key,
+                cache_discovery=False,
+                static_discovery=True,
+            )
+        # httplib2.Http 不是執行緒安全的，每次請求使用獨立的連線
+        return service.cse().list(**params).execute(http=httplib2.Http(timeout=timeout))
+
+    async def google_search(self, q: str, **kwargs) -> Optional[List[dict]]:
+        # 以正規化後的問題作為快取鍵，重複的問題不再消耗配額
+        cache_key = (" ".join(q.lower().split()), tuple(sorted(kwargs.items())))
+        if cache_key in self._google_search_cache:
+            return self._google_search_cache.get(cache_key)
+
         cse = Bot.custom_search_engine_id
+        timeout = Bot.google_search_cache.timeout
+        loop = asyncio.get_running_loop()
+        # 配額用盡的金鑰會被暫停，換下一把金鑰重試
+        while (key := self.google_search_keys.acquire()) is not None:
+            try:
+                res = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        None,
+                        partial(
+                            self._execute_google_search,
+                            key,
+                            timeout,
+                            q=q,
+                            cx=cse,
+                            **Bot.google_search_options,
+                            **kwargs,
+                        ),
+                    ),
+                    timeout=timeout,
+                )
+            except errors.HttpError as e:
+                self.google_search_keys.report_failure(key, e.resp.status)
+                if e.resp.status in ApiKeyPool.QUOTA_STATUSES:
+                    continue
+                logger.error(f"搜索時發生錯誤 ({e.resp.status})")
+                return None
+            except (asyncio.TimeoutError, OSError, httplib2.HttpLib2Error):
+                self.google_search_keys.report_failure(key)
+                logger.error("搜索時逾時或連線失敗")
+                return None
+            except errors.Error:
+                self.google_search_keys.report_failure(key)
+                logger.exception("搜索時發生錯誤")
+                return None
+            break
+        else:
+            logger.error("沒有可用的 Google 搜尋金鑰，可能是皆已超出配額或金鑰無效")
+            return None
+
+        self.google_search_keys.report_success(key)
+        items = res.get("items", None)
+        self._google_search_cache[cache_key] = items
+        return items
+
+    def _trigger_handler(
+        self, trigger: dict
+    ) -> Optional[Callable[[discord.Message], Awaitable[None]]]:
+        return getattr(self, f"_on_{trigger.name}", None)
+
+    async def _run_trigger(self, trigger: dict, msg: discord.Message) -> None:
+        if trigger.images:
+            await self.bot.assets.send(
+                msg,
+                random.choice(trigger.images),
+                delete_after=trigger.delete_after or 7,
+            )
+        elif trigger.reply:
+            await msg.reply(trigger.reply)
+        else:
+            await self._trigger_handler(trigger)(msg)
+
+    # 窩不知道
+    async def _on_idk(self, msg: discord.Message) -> None:
+        images = [i[0] for i in Events.idk]
+        weights = [i[1] for i in Events.idk]
+
+        pic = random.choices(images, weights=weights)[0]
+        if pic.endswith(".gif"):
+            await self.bot.assets.send(msg, pic, delete_after=20)
+        else:
+            await self.bot.assets.send(msg, pic, delete_after=7)
+
+    # 讀取貓咪
+    async def _on_loading_cat(self, msg: discord.Message) -> None:
+        await msg.channel.send(Events.loading_cat[0])
+        await msg.channel.send(Events.loading_cat[1])
+        await msg.channel.send(Events.loading_cat[2])
+
+    # 撒嬌 (訊息)
+    async def _on_act_cute(self, msg: discord.Message) -> None:
+        if random.randint(0, 4) == 4:
+            await msg.reply("還敢撒嬌阿")
+        else:
+            await msg.reply(random.choice(Events.act_cute))
+
+    # 撒嬌 (名稱)
+    async def _on_act_cute_name(self, msg: discord.Message) -> None:
+        await msg.add_reaction(random.choice(Events.act_cute))
+
+    @commands.command(aliases=["bstats"])
+    async def backup_stats(self, ctx: commands.Context, action: str = "") -> None:
+        if not (await self.bot.is_owner(ctx.author)):
+            return
+
+        lines = []
+        if action == "sweep":
+            files, size = await self.bot.backups.sweep(
+                Bot.backup.max_age_days * 86400, Bot.backup.max_bytes
+            )
+            lines.append(f"Swept {files} files, {size / 1048576:.1f} MiB")
+        lines.extend(self.bot.backups.summary())
+        lines.append(
+            f"Retention: {Bot.backup.max_age_days} days"
+            f", {Bot.backup.max_bytes / 1048576:.0f} MiB"
+        )
+
+        report = "\n".join(lines)
+        await ctx.reply(f"```\n{report}\n```", delete_after=60)
+        await ctx.message.delete(delay=60)
+
+    @commands.command(aliases=["arch"])
+    async def archive(self, ctx: commands.Context, *args: str) -> None:
+        """搜尋已刪除及編輯的訊息
+
+        參數格式為 `author:` `channel:` (ID 或名稱)、`since:` `until:` (YYYY-MM-DD)、
+        `page:`，其餘文字皆視為須出現的關鍵字
+        """
+        if not (await self.bot.is_owner(ctx.author)):
+            return
+
+        filters, keywords = {}, []
+        for arg in args:
+            key, sep, value = arg.partition(":")
+            if sep and key in ("author", "channel", "since", "until", "page"):
+                filters[key] = value
+            else:
+                keywords.append(arg)
+
+        tz = timezone(timedelta(hours=8))
         try:
-            service = discovery.build("customsearch", "v1", developerKey=key)
-            res = (
-                service.cse()
-                .list(q=q, cx=cse, **Bot.google_search_options, **kwargs)
-                .execute()
+            since = until = None
+            if "since" in filters:
+                since = datetime.strptime(filters["since"], "%Y-%m-%d")
+                since = since.replace(tzinfo=tz)
+            if "until" in filters:
+                # 包含結束當天
+                until = datetime.strptime(filters["until"], "%Y-%m-%d")
+                until = until.replace(tzinfo=tz) + timedelta(days=1)
+            page = max(int(filters.get("page", 1)), 1)
+        except ValueError:
+            await ctx.reply("日期格式為 YYYY-MM-DD，頁數須為數字", delete_after=10)
+            return
+
+        per_page = Bot.archive.page_size
+        start_time = time.perf_counter()
+        total, records = await self.bot.archive.search(
+            " ".join(keywords),
+            author=filters.get("author"),
+            channel=filters.get("channel"),
+            since=since,
+            until=until,
+            limit=per_page,
+            offset=(page - 1) * per_page,
+        )
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+
+        lines = []
+        for record in records:
+            create_time = datetime.fromtimestamp(record["created_at"], tz)
+            content = record["content"]
+            if record["kind"] == "edit":
+                content = f"{record['before']} `→` {content}"
+            lines.append(
+                f"`{create_time:%Y/%m/%d %H:%M}` #{record['channel_name']}"
+                f" **{record['author_name']}** "
+                f"({'刪除' if record['kind'] == 'delete' else '編輯'})\n"
+                f"{discord.utils.escape_mentions(content)[:200]}"
             )
 
-            return res.get("items", None)
-        except errors.HttpError:
-            logger.error(f"使用 {key} 進行搜索時發生錯誤，可能是超出配額或或金鑰無效")
+        total_page = max((total - 1) // per_page + 1, 1)
+        embed = discord.Embed(
+            title=f"訊息記錄｜{total} 筆",
+            description="\n".join(lines)[:4000] or "沒有符合的記錄",
+            color=discord.Colour.dark_grey(),
+        )
+        embed.set_footer(text=f"第 {page}/{total_page} 頁｜{elapsed_ms:.1f}ms")
+        await ctx.reply(embed=embed, delete_after=120)
+        await ctx.message.delete(delay=120)
+
+    @commands.command(aliases=["gkeys"])
+    async def google_keys(self, ctx: commands.Context) -> None:
+        if not (await self.bot.is_owner(ctx.author)):
+            return
+
+        report = "\n".join(self.google_search_keys.summary())[:1900]
+        await ctx.reply(f"```\n{report}\n```", delete_after=60)
+        await ctx.message.delete(delay=60)
+
+    async def _on_loading_cat_reaction(
+        self, payload: discord.RawReactionActionEvent
+    ) -> None:
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        try:
+            await channel.get_partial_message(payload.message_id).remove_reaction(
+                payload.emoji, discord.Object(payload.user_id)
+            )
+        except discord.HTTPException:
+            pass
 
     @commands.Cog.listener()
     async def on_message(self, msg: discord.Message) -> None:
+        # 登記貓貓訊息，取消對貓貓分屍的行為
+        if any(kw in msg.content for kw in Events.loading_cat[:3]):
+            self.bot.reactions.register_message(msg.id, self._on_loading_cat_reaction)
+
         # 忽略指定頻道
         if msg.channel and msg.channel.id in Bot.ignore_channels:
             return
 
+        # 保存訊息記錄，供超出快取的訊息被刪除或編輯時使用
+        if not msg.author.bot and msg.guild and msg.guild.id != Bot.test_guild:
+            self.messages.add(MessageRecord.from_message(msg))
+
         author_name = msg.author.display_name.lower()
         content = msg.content.lower()
         # mention_names = [u.display_name.lower() for u in msg.mentions]
@@ -115,98 +371,19 @@ class EventHandlers(CogInit):
         # 提及機器人
         if self._is_in_mentions(msg):
             await msg.reply(random.choice(Events.mentioned_reply))
-        # 窩不知道
-        elif re.search(r"[窩我]不知道|idk", content):
-            images = [i[0] for i in Events.idk]
-            weights = [i[1] for i in Events.idk]
-
-            pic = random.choices(images, weights=weights)[0]
-            if pic.endswith(".gif"):
-                await msg.reply(file=discord.File(pic), delete_after=20)
-            else:
-                await msg.reply(file=discord.File(pic), delete_after=7)
-        # 讀取貓咪
-        elif re.search(r"痾|ldc", content) is not None:
-            await msg.channel.send(Events.loading_cat[0])
-            await msg.channel.send(Events.loading_cat[1])
-            await msg.channel.send(Events.loading_cat[2])
-        # 素每
-        elif re.search(r"[好很]熱|素每", content) is not None:
-            pic = discord.File(random.choice(Events.so_hot))
-            await msg.reply(file=pic, delete_after=7)
-        # 六點
-        elif re.search(r"\.{6}|六點|抱歉", content) is not None:
-            await msg.reply(Emojis.i11_chiwawa)
-        # 唐立淇
-        elif re.search(r"星座|唐(?:綺陽|立淇)", content) is not None:
-            pic = discord.File(Events.tang)
-            await msg.reply(file=pic, delete_after=7)
-        # 很嗆是吧
-        elif re.search(r"很?嗆(?:是吧|[喔欸])?", content) is not None:
-            pic = discord.File(Events.flaming)
-            await msg.reply(file=pic, delete_after=7)
-        # 撒嬌 (訊息)
-        elif re.search(r"dount|bakery|撒嬌", content) is not None:
-            if random.randint(0, 4) == 4:
-                await msg.reply("還敢撒嬌阿")
-            else:
-                await msg.reply(random.choice(Events.act_cute))
-        # 撒嬌 (名稱)
-        elif re.search(r"dount|bakery|撒嬌", author_name) is not None:
-            await msg.add_reaction(random.choice(Events.act_cute))
-        # ARKN
-        elif re.search(r"^(arkn|素材)$", content) is not None:
-            pic = discord.File(Events.arkn)
-            await msg.reply(file=pic, delete_after=120)
-        # 神奇海螺
-        elif "神奇海螺" in content and content[:2] != "請問":
-            pic = discord.File(random.choice(Events.magic_conch.kw))
-            await msg.reply(file=pic, delete_after=7)
-        # 菊
-        elif "菊" in content:
-            pic = discord.File(Events.chen)
-            await msg.reply(file=pic, delete_after=7)
-        # 海倫
-        elif "海倫" in content:
-            pic = discord.File(random.choice(Events.helen_cards))
-            await msg.reply(file=pic, delete_after=7)
-        # 好色
-        elif "好色" in content:
-            pic = discord.File(Events.ck_lewd)
-            await msg.reply(file=pic, delete_after=7)
-        # 假的
-        elif "假的" in content:
-            pic = discord.File(Events.fake)
-            await msg.reply(file=pic, delete_after=7)
-        # 很壞
-        elif "很壞" in content:
-            pic = discord.File(Events.you_bad)
-            await msg.reply(file=pic, delete_after=7)
-        # 好耶
-        elif "好耶" in content:
-            pic = discord.File(random.choice(Events.yeah))
-            await msg.reply(file=pic, delete_after=7)
-        # 陷阱卡
-        elif "陷阱卡" in content:
-            pic = discord.File(Events.trap_card)
-            await msg.reply(file=pic, delete_after=7)
-        # 交朋友
-        elif "交朋友" in content:
-            pic = discord.File(random.choice(Events.make_friends))
-            await msg.reply(file=pic, delete_after=7)
-        # 怕
-        elif "怕" in content:
-            pic = discord.File(Events.scared)
-            await msg.reply(file=pic, delete_after=7)
+        # 關鍵字觸發，只觸發優先序最高的規則
+        elif trigger := self.triggers.match(content=content, author=author_name):
+            await self._run_trigger(trigger, msg)
         # 請問
         if content.startswith("請問"):
             if content[2:4] == "晚餐":
                 await msg.reply(random.choice(Events.meals))
             elif content[2:6] == "神奇海螺":
-                pic = discord.File(random.choice(Events.magic_conch.ask))
-                await msg.reply(file=pic, delete_after=7)
+                await self.bot.assets.send(
+                    msg, random.choice(Events.magic_conch.ask), delete_after=7
+                )
             else:
-                result = self.google_search(content[2:], num=1)
+                result = await self.google_search(content[2:], num=1)
                 if result is None:
                     await msg.reply(
                         f"很遺憾\n你問的東西連 Google 都回答不了你 {Emojis.pepe_coffee}",
@@ -220,97 +397,136 @@ class EventHandlers(CogInit):
         for i, att in enumerate(msg.attachments):
             ext = att.filename.split(".")[-1]
             if self._is_image(ext):
-                await att.save(self.backup_path / Path(f"{msg.id}_{i:02d}.{ext}"))
+                self.bot.backups.enqueue(
+                    msg.id,
+                    i,
+                    att.url,
+                    ext,
+                    att.size,
+                    guild_id=msg.guild.id,
+                    channel_id=msg.channel.id,
+                    author_id=msg.author.id,
+                )
+
+    def _pop_record(
+        self, message_id: int, cached: Optional[discord.Message]
+    ) -> Optional[MessageRecord]:
+        # 優先使用自行保存的記錄，超出 discord.py 快取的訊息也能取得內容
+        record = self.messages.pop(message_id)
+        if record is None and cached is not None and not cached.author.bot:
+            record = MessageRecord.from_message(cached)
+        return record
 
     @commands.Cog.listener()
-    async def on_message_edit(
-        self, before: discord.Message, after: discord.Message
-    ) -> None:
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
         # 忽略頻道
-        if after.channel and after.channel.id in Bot.ignore_channels:
-            return
-        # 忽略機器人
-        if after.author.bot:
+        if payload.channel_id in Bot.ignore_channels:
             return
         # 忽略私訊及測試群組
-        if not after.guild or after.guild.id == Bot.test_guild:
+        guild_id = payload.data.get("guild_id")
+        if guild_id is None or int(guild_id) == Bot.test_guild:
+            return
+        # 僅內嵌內容更新，非使用者編輯
+        if "content" not in payload.data:
+            return
+
+        before = self._pop_record(payload.message_id, payload.cached_message)
+        # 忽略機器人及沒有記錄的訊息
+        if before is None:
             return
+
+        after_content = payload.data["content"]
+        self.messages.add(
+            MessageRecord(
+                before.id,
+                before.author_id,
+                before.author_name,
+                before.channel_id,
+                after_content,
+                before.attachments,
+            )
+        )
         # 前後訊息內容相同，略過
-        if before.content.lower() == after.content.lower():
+        if before.content.lower() == after_content.lower():
             return
 
-        author = after.author
-        channel = after.channel
-        create_time = (after.edited_at + timedelta(hours=8)).strftime(
+        channel = self.bot.get_channel(payload.channel_id)
+        edited_at = discord.utils.parse_time(payload.data.get("edited_timestamp"))
+        create_time = ((edited_at or datetime.utcnow()) + timedelta(hours=8)).strftime(
             "%Y/%m/%d %H:%M:%S"
         )
-        # 尋找已備份的圖片檔
-        files = [
-            f for f in self.backup_path.iterdir() if f.name.startswith(str(after.id))
-        ]
+        await self.bot.archive.add(
+            "edit",
+            before.id,
+            before.author_id,
+            before.author_name,
+            before.channel_id,
+            channel.name,
+            before.created_at,
+            after_content,
+            before=before.content,
+        )
+        # 等待尚未下載完成的備份
+        await self.bot.backups.wait(before.id, Bot.backup.download_wait)
         await self.bot.get_channel(Bot.edit_backup_channel).send(
-            f"{author.display_name} `{author.id}`｜{channel.name} `{create_time}`\n"
-            f"{before.content} `→` {after.content}",
-            files=[discord.File(file) for file in files],
+            f"{before.author_name} `{before.author_id}`｜{channel.name} `{create_time}`\n"
+            f"{before.content} `→` {after_content}",
+            files=self._backup_files(before.id),
         )
 
     @commands.Cog.listener()
-    async def on_message_delete(self, msg: discord.Message) -> None:
-        # 忽略機器人
-        if msg.author.bot:
+    async def on_raw_message_delete(
+        self, payload: discord.RawMessageDeleteEvent
+    ) -> None:
+        record = self._pop_record(payload.message_id, payload.cached_message)
+        # 忽略機器人及沒有記錄的訊息
+        if record is None:
+            await self.bot.backups.remove(payload.message_id)
             return
         # 忽略私訊及測試群組
-        if not msg.guild or msg.guild.id == Bot.test_guild:
+        if payload.guild_id is None or payload.guild_id == Bot.test_guild:
             return
         # 忽略指令
-        if self._is_command(msg.content):
+        if self._is_command(record.content):
+            await self.bot.backups.remove(record.id)
             return
 
+        channel = self.bot.get_channel(payload.channel_id)
         # 無限讀取貓咪
         if any(
-            kw in msg.content
+            kw in record.content
             for kw in (
                 Events.loading_cat[0],
                 Events.loading_cat[1],
                 Events.loading_cat[2],
             )
         ):
-            await msg.channel.send(Events.loading_cat[0])
-            await msg.channel.send(Events.loading_cat[1])
-            await msg.channel.send(Events.loading_cat[2])
+            await channel.send(Events.loading_cat[0])
+            await channel.send(Events.loading_cat[1])
+            await channel.send(Events.loading_cat[2])
 
-        author = msg.author
-        channel = msg.channel
-        create_time = (msg.created_at + timedelta(hours=8)).strftime(
+        create_time = (record.created_at + timedelta(hours=8)).strftime(
             "%Y/%m/%d %H:%M:%S"
         )
-        # 尋找已備份的圖片檔
-        files = [
-            f for f in self.backup_path.iterdir() if f.name.startswith(str(msg.id))
-        ]
+        await self.bot.archive.add(
+            "delete",
+            record.id,
+            record.author_id,
+            record.author_name,
+            record.channel_id,
+            channel.name,
+            record.created_at,
+            record.content,
+        )
+        # 等待尚未下載完成的備份
+        await self.bot.backups.wait(record.id, Bot.backup.download_wait)
         await self.bot.get_channel(Bot.chat_backup_channel).send(
-            f"{author.display_name} `{author.id}`｜{channel.name} `{create_time}`\n"
-            f"{msg.content}",
-            files=[discord.File(file) for file in files],
+            f"{record.author_name} `{record.author_id}`｜{channel.name} `{create_time}`\n"
+            f"{record.content}",
+            files=self._backup_files(record.id),
         )
         # 刪除圖片
-        for file in files:
-            file.unlink()
-
-    @commands.Cog.listener()
-    async def on_reaction_add(
-        self, reaction: discord.Reaction, user: discord.User
-    ) -> None:
-        # 取消對貓貓分屍的行為
-        if any(
-            kw in reaction.message.content
-            for kw in (
-                Events.loading_cat[0],
-                Events.loading_cat[1],
-                Events.loading_cat[2],
-            )
-        ):
-            await reaction.message.remove_reaction(reaction, user)
+        await self.bot.backups.remove(record.id)
 
 
 def setup(bot: ItkBot) -> None:
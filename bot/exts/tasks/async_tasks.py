@@ -21,8 +21,9 @@ class AsyncTasks(CogInit):
             else:
                 await discord.utils.sleep_until(DatetimeUtils.tomorrow_with(hour=3))
 
-            pic = discord.File(Tasks.three_oclock)
-            await self.bot.get_channel(Bot.main_channel).send("好棒，三點了", file=pic)
+            await self.bot.assets.send(
+                self.bot.get_channel(Bot.main_channel), Tasks.three_oclock, "好棒，三點了"
+            )
 
         self._THREE_OCLOCK_TASK = self.bot.loop.create_task(three_oclock())
 
@@ -34,8 +35,9 @@ class AsyncTasks(CogInit):
                 DatetimeUtils.next_weekday_with(DatetimeUtils.Weekdays.SUNDAY, hour=21)
             )
 
-            pic = discord.File(Tasks.left_three_hours)
-            await self.bot.get_channel(Bot.main_channel).send(file=pic)
+            await self.bot.assets.send(
+                self.bot.get_channel(Bot.main_channel), Tasks.left_three_hours
+            )
 
         self._LEFT_THREE_HOURS_TASK = self.bot.loop.create_task(left_three_hours())
 
@@ -49,8 +51,9 @@ class AsyncTasks(CogInit):
                 )
             )
 
-            pic = discord.File(Tasks.left_ten_seconds)
-            await self.bot.get_channel(Bot.main_channel).send(file=pic)
+            await self.bot.assets.send(
+                self.bot.get_channel(Bot.main_channel), Tasks.left_ten_seconds
+            )
 
         self._LEFT_TEN_SECONDS_TASK = self.bot.loop.create_task(left_ten_seconds())
 